@@ -0,0 +1,151 @@
+import os
+import psycopg2
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
+import time
+
+
+def get_connection():
+    """Returns a new psycopg2 connection to the target database.
+    """
+    return psycopg2.connect(
+        host=os.getenv('DATABASE_HOST'),
+        user=os.getenv('DATABASE_USERNAME'),
+        password=os.getenv('DATABASE_PASSWORD'),
+        dbname=os.getenv('DATABASE_NAME'),
+    )
+
+
+def get_connection_pool(maxconn):
+    """Returns a thread-safe pool of up to maxconn connections to the target database.
+    """
+    return ThreadedConnectionPool(
+        1,
+        maxconn,
+        host=os.getenv('DATABASE_HOST'),
+        user=os.getenv('DATABASE_USERNAME'),
+        password=os.getenv('DATABASE_PASSWORD'),
+        dbname=os.getenv('DATABASE_NAME'),
+    )
+
+
+def launder(name):
+    """Returns the table/column name that ogr2ogr creates for a source name (PostgreSQL driver
+    LAUNDER=YES behaviour).
+    """
+    return name.lower().replace('-', '_').replace('#', '_')
+
+
+def get_geometry_column(conn, table, schema='public'):
+    """Returns the name of a table's geometry column, or None for a non-spatial table.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            'SELECT f_geometry_column FROM geometry_columns WHERE f_table_schema = %s AND f_table_name = %s',
+            (schema, table),
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def create_spatial_index(conn, table, schema='public'):
+    """Create a GiST index on a table's geometry column (named as ogr2ogr would), if one does
+    not already exist. Returns the index name, or None if the table has no geometry column.
+    """
+    column = get_geometry_column(conn, table, schema)
+    if not column:
+        return None
+    index = '{}_{}_geom_idx'.format(table, column)
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('CREATE INDEX IF NOT EXISTS {} ON {}.{} USING GIST ({})').format(
+            sql.Identifier(index),
+            sql.Identifier(schema),
+            sql.Identifier(table),
+            sql.Identifier(column),
+        ))
+    conn.commit()
+    return index
+
+
+def optimise_table(pool, table, schema='public', cluster=False):
+    """Post-load optimisation of a newly-loaded table, using a connection from the pool:
+    ensure that the spatial index exists, optionally CLUSTER the table on it (this takes an
+    exclusive lock on the table), then ANALYZE the table.
+    Returns a dict of the elapsed time (in seconds) of each step.
+    """
+    timings = {}
+    conn = pool.getconn()
+    try:
+        start = time.time()
+        index = create_spatial_index(conn, table, schema)
+        timings['index'] = time.time() - start
+        with conn.cursor() as cur:
+            if cluster and index:
+                start = time.time()
+                cur.execute(sql.SQL('CLUSTER {}.{} USING {}').format(
+                    sql.Identifier(schema), sql.Identifier(table), sql.Identifier(index)))
+                conn.commit()
+                timings['cluster'] = time.time() - start
+            start = time.time()
+            cur.execute(sql.SQL('ANALYZE {}.{}').format(sql.Identifier(schema), sql.Identifier(table)))
+            conn.commit()
+            timings['analyze'] = time.time() - start
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+    return timings
+
+
+def count_rows(conn, table, schema='public'):
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('SELECT count(*) FROM {}.{}').format(sql.Identifier(schema), sql.Identifier(table)))
+        count = cur.fetchone()[0]
+    conn.commit()
+    return count
+
+
+def drop_table(conn, table, schema='public'):
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('DROP TABLE IF EXISTS {}.{} CASCADE').format(sql.Identifier(schema), sql.Identifier(table)))
+    conn.commit()
+
+
+def finalise_staging_table(conn, staging, table, schema='public'):
+    """Replace a table with a fully-loaded staging table, in a single transaction: the table is
+    dropped (as ogr2ogr -overwrite would), then the staging table and its indexes & FID sequence
+    are renamed to the names that ogr2ogr would have given them. The FID sequence is set to
+    follow the table's highest FID.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL('DROP TABLE IF EXISTS {}.{} CASCADE').format(sql.Identifier(schema), sql.Identifier(table)))
+            cur.execute(sql.SQL('ALTER TABLE {}.{} RENAME TO {}').format(
+                sql.Identifier(schema), sql.Identifier(staging), sql.Identifier(table)))
+            cur.execute('SELECT indexname FROM pg_indexes WHERE schemaname = %s AND tablename = %s', (schema, table))
+            for (index,) in cur.fetchall():
+                if index.startswith(staging):
+                    cur.execute(sql.SQL('ALTER INDEX {}.{} RENAME TO {}').format(
+                        sql.Identifier(schema), sql.Identifier(index), sql.Identifier(table + index[len(staging):])))
+            # Sequences owned by the table's columns (i.e. the serial FID column).
+            cur.execute(
+                """SELECT s.relname, a.attname FROM pg_depend d
+                JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+                JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+                WHERE d.refobjid = %s::regclass AND d.deptype IN ('a', 'i')""",
+                (sql.SQL('{}.{}').format(sql.Identifier(schema), sql.Identifier(table)).as_string(conn),),
+            )
+            for sequence, column in cur.fetchall():
+                if sequence.startswith(staging):
+                    sequence_name = table + sequence[len(staging):]
+                    cur.execute(sql.SQL('ALTER SEQUENCE {}.{} RENAME TO {}').format(
+                        sql.Identifier(schema), sql.Identifier(sequence), sql.Identifier(sequence_name)))
+                    sequence = sequence_name
+                cur.execute(sql.SQL('SELECT setval(%s, COALESCE(MAX({}), 0) + 1, false) FROM {}.{}').format(
+                    sql.Identifier(column), sql.Identifier(schema), sql.Identifier(table)),
+                    (sql.SQL('{}.{}').format(sql.Identifier(schema), sql.Identifier(sequence)).as_string(conn),))
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
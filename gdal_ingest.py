@@ -0,0 +1,138 @@
+import time
+
+from utils import get_pg_string, logger_setup
+
+try:
+    from osgeo import gdal
+except ImportError:  # The GDAL Python bindings are only required for the 'gdal' ingest backend.
+    gdal = None
+
+
+# Configure logging.
+LOGGER = logger_setup()
+# The database datasource for this worker process, opened once and reused for every layer.
+PG_DS = None
+
+
+def check_bindings():
+    """Raises ImportError if the GDAL Python bindings are not installed. Call this before
+    starting a Pool of workers using init_worker.
+    """
+    if gdal is None:
+        raise ImportError('The GDAL Python bindings (osgeo) are required for the gdal ingest backend')
+
+
+def init_worker():
+    """Pool initializer: open a PostgreSQL datasource to be held open by the worker process.
+    Errors are logged rather than raised, as a Pool worker whose initializer fails is replaced
+    (and fails again) indefinitely; copy_layer tries again to open the datasource, and fails
+    the layer if it cannot.
+    """
+    global PG_DS
+    try:
+        check_bindings()
+        PG_DS = gdal.OpenEx('PG:{}'.format(get_pg_string()), gdal.OF_VECTOR | gdal.OF_UPDATE)
+        if PG_DS is None:
+            raise RuntimeError('Unable to open the PostgreSQL datasource: {}'.format(gdal.GetLastErrorMsg()))
+    except (ImportError, RuntimeError):
+        LOGGER.exception('GDAL ingest worker initialisation failed')
+        PG_DS = None
+
+
+def open_source(file_gdb):
+    """Open a file GDB read-only. Returns the datasource (None if it could not be opened).
+    """
+    if gdal is None:
+        raise ImportError('The GDAL Python bindings (osgeo) are required for the gdal ingest backend')
+    return gdal.OpenEx(file_gdb, gdal.OF_VECTOR | gdal.OF_READONLY)
+
+
+def translate(src, layer_name, geometry_type=None, load_options=None):
+    """Copy a layer from the source datasource into the worker's PostgreSQL datasource,
+    overwriting any existing table, optionally applying a dict of load profile options.
+    Returns a tuple of (success, [GDAL error/warning messages]).
+    """
+    messages = []
+    load_options = load_options or {'gt': None, 'config': {}, 'lco': {}}
+    extra = ['-gt', str(load_options['gt'])] if load_options['gt'] else []
+    gdal.PushErrorHandler(lambda err_class, err_no, msg: messages.append(msg))
+    # Config options are process-wide, so restore the previous values afterwards.
+    previous_config = {k: gdal.GetConfigOption(k) for k in load_options['config']}
+    for key, value in load_options['config'].items():
+        gdal.SetConfigOption(key, str(value))
+    try:
+        options = gdal.VectorTranslateOptions(
+            options=extra,
+            layers=[layer_name],
+            accessMode='overwrite',
+            geometryType=geometry_type,
+            layerCreationOptions=['{}={}'.format(k, v) for k, v in load_options['lco'].items()],
+        )
+        result = gdal.VectorTranslate(PG_DS, src, options=options)
+    finally:
+        for key, value in previous_config.items():
+            gdal.SetConfigOption(key, value)
+        gdal.PopErrorHandler()
+    return result is not None, messages
+
+
+def copy_layer(file_gdb, layer_name, logger=None, geometry_type=None, src=None, load_options=None):
+    """Copy a single file GDB layer to the PostgreSQL database in-process, using the GDAL
+    Python bindings, optionally with an explicit geometry type and a dict of load profile
+    options. An already-opened source datasource for the file GDB may be passed in to be reused.
+    Returns a dict of copy statistics, or None if the copy failed.
+    """
+    global PG_DS
+    if PG_DS is None:  # Not initialised, or the connection was reset after an earlier failure.
+        init_worker()
+        if PG_DS is None:
+            if logger:
+                logger.error('Unable to copy layer {}: no PostgreSQL datasource'.format(layer_name))
+            return
+    start = time.time()
+
+    if src is None:
+        src = open_source(file_gdb)
+    src_layer = src.GetLayerByName(layer_name) if src else None
+    if src_layer is None:
+        if logger:
+            logger.error('Unable to open layer {} in {}'.format(layer_name, file_gdb))
+        return
+    features = src_layer.GetFeatureCount()
+
+    success, messages = translate(src, layer_name, geometry_type, load_options)
+    copy_failed = any('COPY statement failed' in m for m in messages)
+
+    # NONSTANDARD GEOMETRY TYPE HANDLING (see ingester.ogr2ogr_copy).
+    retry_type = None
+    if copy_failed and any('type Multi Surface' in m for m in messages):
+        if logger:
+            logger.warning('Copy statement failed, geometry type Multi Surface, trying explicit geom type MULTIPOLYGON')
+        retry_type = 'MULTIPOLYGON'
+    elif copy_failed and any('type Multi Curve' in m for m in messages):
+        if logger:
+            logger.warning('Copy statement failed, geometry type Multi Curve, trying explicit geom type MULTILINESTRING')
+        retry_type = 'MULTILINESTRING'
+    retry_reason = None
+    if retry_type and retry_type != geometry_type:
+        retry_reason = 'COPY statement failed, retried as {}'.format(retry_type)
+        geometry_type = retry_type
+        success, messages = translate(src, layer_name, geometry_type, load_options)
+        copy_failed = any('COPY statement failed' in m for m in messages)
+
+    # A failed COPY statement fails the layer, even where the translation otherwise succeeded.
+    if not success or copy_failed:
+        if logger:
+            logger.error('GDAL copy failed for layer {} in {}: {}'.format(layer_name, file_gdb, '; '.join(messages)))
+        # The connection may be left in an aborted transaction; reopen it for the next layer.
+        PG_DS = None
+        return
+
+    PG_DS.FlushCache()
+    return {
+        'layer': layer_name,
+        'features': features,
+        'elapsed': time.time() - start,
+        'geometry_type': geometry_type,
+        'retry_reason': retry_reason,
+    }
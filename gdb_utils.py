@@ -1,97 +1,217 @@
+import atexit
 from bs4 import BeautifulSoup
-import io
+from geoserver import get_client
 import json
+from multiprocessing.util import Finalize
 import os
 from osgeo import ogr
-from qgis.core import QgsApplication, QgsVectorLayer
-import requests
+from qml2sld import clean_sld, SLD_CLEANUP_VERSION, TRANSLATOR_VERSION
 import tempfile
+from utils import parse_layer_href, get_layer_resource, update_layer_resource
 import xml.etree.ElementTree as ET
 
+try:
+    from qgis.core import Qgis, QgsApplication, QgsVectorLayer
+except ImportError:  # QGIS is only required to convert styles that qml2sld cannot translate.
+    Qgis = QgsApplication = QgsVectorLayer = None
 
-def get_auth():
-    return (os.getenv('GEOSERVER_USERNAME'), os.getenv('GEOSERVER_PASSWORD'))
 
+# The QGIS application for this process (see init_qgis).
+QGIS_APP = None
 
-def get_metadata(gdb_path, layer):
-    """For a given file GDB path and layer, return the metadata XML string.
+
+def open_gdb(gdb_path):
+    """Open a file GDB read-only using the OpenFileGDB driver. Returns the datasource.
     """
     driver = ogr.GetDriverByName("OpenFileGDB")
-    fgdb = driver.Open(gdb_path, 0)
+    return driver.Open(gdb_path, 0)
+
+
+def get_metadata(gdb_path, layer, fgdb=None):
+    """For a given file GDB path and layer, return the metadata XML string.
+    An already-opened file GDB datasource may be passed in to be reused.
+    """
+    if fgdb is None:
+        fgdb = open_gdb(gdb_path)
     metadata_layer = fgdb.ExecuteSQL("GetLayerMetadata {}".format(layer))
     metadata_string = metadata_layer.GetFeature(0).GetFieldAsString(0)
     return metadata_string
 
 
+def html_text(html):
+    """Returns the text of an HTML fragment, minus any markup.
+    """
+    if not html:
+        return None
+    return BeautifulSoup(html, 'lxml').text.strip()
+
+
+def parse_metadata(metadata):
+    """For a given XML metadata string, parse the document once and return a dict of the fields
+    that we use: title, abstract (text, minus any markup), purpose, credit and keywords.
+    """
+    root = ET.fromstring(metadata)
+    return {
+        'title': root.findtext('./dataIdInfo/idCitation/resTitle'),
+        'abstract': html_text(root.findtext('./dataIdInfo/idAbs')),
+        'purpose': html_text(root.findtext('./dataIdInfo/idPurp')),
+        'credit': root.findtext('./dataIdInfo/idCredit'),
+        'keywords': [el.text for el in root.findall('./dataIdInfo/searchKeys/keyword') if el.text],
+    }
+
+
 def get_abstract(metadata):
     """For a given XML metadata string, return the abstract text (minus any markup).
     """
-    root = ET.fromstring(metadata)
-    abstract_element = root.find('./dataIdInfo/idAbs')
-    if abstract_element is None:
-        return None
-    abstract_html = abstract_element.text
-    abstract_text = BeautifulSoup(abstract_html, 'lxml').text.strip()
-    return abstract_text
+    return parse_metadata(metadata)['abstract']
 
 
 def get_title(metadata):
     """For a given XML metadata string, return the title.
     """
-    root = ET.fromstring(metadata)
-    title_element = root.find('./dataIdInfo/idCitation/resTitle')
-    if title_element is None:
-        return None
-    return title_element.text
+    return parse_metadata(metadata)['title']
 
 
-def get_resource(layer_href, use_https=True):
-    """Get the resource object details for a layer. Returns a tuple of
-    (resource_href, dict).
+def extract_gdb_metadata(gdb_path, fgdb=None):
+    """Open a file GDB once and extract the metadata for all of its layers, parsing each
+    metadata document once. Returns a dict of {layer_name: record}, where each record contains
+    the parsed fields (see parse_metadata, which are None for a layer without metadata), the
+    layer schema (see get_layer_schema) and whether the layer has metadata. The metadata XML
+    itself is not kept (see get_metadata).
     """
-    # First, get the layer's existing details.
-    auth = get_auth()
-    r = requests.get(layer_href, auth=auth)
-    if not r.status_code == 200:
-        r.raise_for_status()
-    d = r.json()
-    # Next retrieve the layer's resource URL and get those details.
-    # We can infer this URL from the layer name, but let's be cautious.
-    resource_href = d['layer']['resource']['href']
-    if use_https and not resource_href.startswith('https'):
-        resource_href = resource_href.replace('http', 'https')
-    r = requests.get(resource_href, auth=auth)
-    if not r.status_code == 200:
-        r.raise_for_status()
-    return (resource_href, r.json())
+    if fgdb is None:
+        fgdb = open_gdb(gdb_path)
+    records = {}
+    for i in range(fgdb.GetLayerCount()):
+        layer = fgdb.GetLayerByIndex(i).GetName()
+        metadata_layer = fgdb.ExecuteSQL("GetLayerMetadata {}".format(layer))
+        metadata = metadata_layer.GetFeature(0).GetFieldAsString(0) if metadata_layer else ''
+        if metadata_layer:
+            fgdb.ReleaseResultSet(metadata_layer)
+        if metadata:
+            record = parse_metadata(metadata)
+        else:
+            record = {'title': None, 'abstract': None, 'purpose': None, 'credit': None, 'keywords': []}
+        record['schema'] = get_layer_schema(fgdb, layer)
+        record['has_metadata'] = bool(metadata)
+        records[layer] = record
+    return records
+
+
+def get_resource(layer_href, use_https=True, refresh=False):
+    """Get the resource object details for a layer (from the catalog snapshot, where current,
+    unless refresh is True). Returns a tuple of (resource_href, dict).
+    """
+    workspace, layer = parse_layer_href(layer_href)
+    return get_layer_resource(workspace, layer, layer_href, use_https, refresh)
 
 
 def update_resource(layer_href, attr):
     """Update a layer's resource object using a passed-in dict on the resource attributes and values.
     """
-    # Get the resource object.
-    resource_href, d = get_resource(layer_href)
+    # Get the current resource object (it is PUT back whole, so not from the catalog snapshot).
+    resource_href, d = get_resource(layer_href, refresh=True)
     for key, value in attr.items():
         d['featureType'][key] = value
     data = json.dumps(d)
     headers = {'content-type': 'application/json'}
-    r = requests.put(resource_href, auth=get_auth(), headers=headers, data=data)
+    r = get_client().put(resource_href, headers=headers, data=data)
     if not r.status_code == 200:
         r.raise_for_status()
+    update_layer_resource(*parse_layer_href(layer_href), resource_href, d)
     return
 
 
-def convert_qml(gdb_path, layer, qml_path, logger=None):
-    """Convert a QML style definition into an SLD. Returns the XML string.
+def reconcile_resource(layer_href, attr):
+    """Compare a passed-in dict of resource attributes and values against a layer's resource
+    object in the catalog snapshot. No request is made if none differ; otherwise the current
+    resource object is fetched, and PUT back whole with the differing attributes updated.
+    Returns a dict of the changed attributes and their new values.
     """
+    resource_href, d = get_resource(layer_href)
+    changed = {key: value for key, value in attr.items() if d['featureType'].get(key) != value}
+    if not changed:
+        return changed
+    # The snapshot may be out of date, so compare again against the current resource object.
+    resource_href, d = get_resource(layer_href, refresh=True)
+    changed = {key: value for key, value in attr.items() if d['featureType'].get(key) != value}
+    if not changed:
+        return changed
+    d['featureType'].update(changed)
+    data = json.dumps(d)
+    headers = {'content-type': 'application/json'}
+    r = get_client().put(resource_href, headers=headers, data=data)
+    if not r.status_code == 200:
+        r.raise_for_status()
+    update_layer_resource(*parse_layer_href(layer_href), resource_href, d)
+    return changed
+
+
+def qgis_available():
+    """Returns True if the QGIS Python bindings (qgis.core) could be imported.
+    """
+    return QgsApplication is not None
+
+
+def init_qgis():
+    """Initialise a QGIS application for this process, if not already initialised, and
+    return it. The application is reused for all subsequent style conversions, and exited
+    when the process exits (including multiprocessing Pool workers).
+    """
+    global QGIS_APP
+    if QGIS_APP is not None:
+        return QGIS_APP
+    if QgsApplication is None:
+        raise ImportError('The QGIS Python bindings (qgis.core) are required to convert this style')
+
     # Ensure that the required Qt env var is set.
     if not os.getenv('QT_QPA_PLATFORM'):
         os.environ['QT_QPA_PLATFORM'] = 'offscreen'
 
-    # Initialise a QGIS application.
     QgsApplication.setPrefixPath('/usr', True)
-    qgis = QgsApplication([], False)
-    qgis.initQgis()
+    QGIS_APP = QgsApplication([], False)
+    QGIS_APP.initQgis()
+    # Pool workers exit without running atexit handlers, but do run multiprocessing finalizers.
+    Finalize(None, exit_qgis, exitpriority=10)
+    atexit.register(exit_qgis)
+    return QGIS_APP
+
+
+def exit_qgis():
+    """Exit this process's QGIS application, if one has been initialised.
+    """
+    global QGIS_APP
+    if QGIS_APP is not None:
+        QGIS_APP.exitQgis()
+        QGIS_APP = None
+
+
+def get_converter_version():
+    """Returns a string identifying the version of the QML to SLD conversion (the native
+    translator version, the QGIS version and the SLD clean-up version), for use in style cache keys.
+    """
+    qgis_version = Qgis.QGIS_VERSION if Qgis is not None else 'none'
+    return 'native-{}/qgis-{}/cleanup-{}'.format(TRANSLATOR_VERSION, qgis_version, SLD_CLEANUP_VERSION)
+
+
+def get_layer_schema(fgdb, layer):
+    """For an opened file GDB datasource and layer name, returns a string describing the
+    layer's geometry type and fields (used in style cache keys).
+    """
+    lyr = fgdb.GetLayerByName(layer)
+    if lyr is None:
+        return ''
+    defn = lyr.GetLayerDefn()
+    fields = ['{}:{}'.format(defn.GetFieldDefn(i).GetName(), defn.GetFieldDefn(i).GetTypeName())
+              for i in range(defn.GetFieldCount())]
+    return '{}|{}'.format(ogr.GeometryTypeToName(lyr.GetGeomType()), ','.join(fields))
+
+
+def convert_qml(gdb_path, layer, qml_path, logger=None):
+    """Convert a QML style definition into an SLD. Returns the XML string.
+    """
+    # Use this process's QGIS application (initialised on first use).
+    init_qgis()
 
     uri = '{}|layername={}'.format(gdb_path, layer)
     vector_layer = QgsVectorLayer(uri, layer, 'ogr')
@@ -101,38 +221,15 @@ def convert_qml(gdb_path, layer, qml_path, logger=None):
             logger.error('Error loading QML for {}: {}'.format(layer, load_msg))
         return
 
-    sld_file = tempfile.NamedTemporaryFile(prefix=layer, suffix='.sld', delete=False)
-    write_msg, write_success = vector_layer.saveSldStyle(sld_file.name)
-    if not write_success:
-        if logger:
-            logger.error('Error writing SLD for {}: {}'.format(layer, write_msg))
-        return
-
-    # Define XML namespaces.
-    ns = {
-        'sld': 'http://www.opengis.net/sld',
-        'se': 'http://www.opengis.net/se',
-        'ogc': 'http://www.opengis.net/ogc',
-        'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
-    }
-    # Parse the SLD.
-    root = ET.fromstring(sld_file.read())
-    # Alter any Name elements where the element value == layer (uppercase).
-    for el in root.findall('.//se:Name', ns):
-        if el.text == layer:
-            el.text = el.text.lower()
-    # Alter any PropertyName element values to lowercase (these are db column names).
-    for el in root.findall('.//ogc:PropertyName', ns):
-        el.text = el.text.lower()
-    # TODO: additional SLD cleansing.
-
-    # Return the XML string.
-    ET.register_namespace('', 'http://www.opengis.net/sld')  # Register default namespace
-    for k, v in ns.items():  # Register remaining namespaces.
-        ET.register_namespace(k, v)
-    # Write a new XML tree to a file, then return the contents.
-    tree = ET.ElementTree(root)
-    f = io.StringIO()
-    tree.write(f, encoding='unicode')
-    f.seek(0)
-    return f.read()
+    # Write the SLD to a temporary directory, which is removed afterwards.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sld_path = os.path.join(tmp_dir, '{}.sld'.format(layer))
+        write_msg, write_success = vector_layer.saveSldStyle(sld_path)
+        if not write_success:
+            if logger:
+                logger.error('Error writing SLD for {}: {}'.format(layer, write_msg))
+            return
+        with open(sld_path, 'rb') as f:
+            sld = f.read()
+
+    return clean_sld(sld, layer)
@@ -0,0 +1,61 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# One client per process (sessions must not be shared across forked processes).
+CLIENTS = {}
+
+
+class GeoServerClient(object):
+    """HTTP client for GeoServer, using a keep-alive requests Session with a sized connection pool,
+    a default timeout, and retries with exponential backoff on connection errors and 5xx responses.
+    Only idempotent methods are retried after a 5xx response.
+    """
+
+    def __init__(self, username=None, password=None, pool_size=None, timeout=None, retries=None, backoff=None):
+        self.auth = (username or os.getenv('GEOSERVER_USERNAME'), password or os.getenv('GEOSERVER_PASSWORD'))
+        self.timeout = timeout or float(os.getenv('GEOSERVER_TIMEOUT', 60))
+        pool_size = pool_size or int(os.getenv('GEOSERVER_POOL_SIZE', 10))
+        retry = Retry(
+            total=retries if retries is not None else int(os.getenv('GEOSERVER_RETRIES', 3)),
+            backoff_factor=backoff if backoff is not None else float(os.getenv('GEOSERVER_BACKOFF', 0.5)),
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=frozenset(['GET', 'HEAD', 'PUT', 'DELETE']),
+            raise_on_status=False,  # Return the final response, for the caller to check.
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, authenticate=True, **kwargs):
+        """Make a request, authenticated as the GeoServer user unless authenticate is False
+        (e.g. for public OGC service requests). Returns the response object.
+        """
+        if authenticate:
+            kwargs.setdefault('auth', self.auth)
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+def get_client():
+    """Returns the GeoServer client for the current process.
+    """
+    pid = os.getpid()
+    if pid not in CLIENTS:
+        CLIENTS[pid] = GeoServerClient()
+    return CLIENTS[pid]
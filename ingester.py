@@ -1,15 +1,49 @@
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from multiprocessing import Pool, Value
+from functools import partial
+import math
+from multiprocessing import Pool
 import os
+import psycopg2
+import shlex
 import subprocess
+import time
+import uuid
 
-from utils import logger_setup, parse_cddp, get_available_featuretypes, publish_featuretype
+from db import (
+    count_rows, create_spatial_index, drop_table, finalise_staging_table, get_connection, get_connection_pool, launder, optimise_table,
+)
+import gdal_ingest
+from journal import start_run, record_done, record_failed, finish_run
+from manifest import (
+    gdb_fingerprints, manifest_connect, layer_unchanged, record_layer, get_geometry_type, record_geometry_type,
+    record_duration,
+)
+from profiles import get_load_options, load_profile_config, ogr2ogr_args
+from report import summarise, write_json_report, write_prometheus_textfile
+from scheduler import (
+    batch_datasets, estimate_costs, get_source_bytes, get_worker_count, parse_shard, predict_makespan,
+    predict_static_makespan, schedule, shard_datasets,
+)
+from utils import (
+    logger_setup, get_pg_string, get_state_path, get_layer_feature_count, get_layer_geometry_type, parse_cddp,
+    get_available_featuretypes, publish_featuretype,
+)
+from work_queue import (
+    LeaseHeartbeat, claim_task, complete_task, enqueue_tasks, get_results, get_worker_id, queue_connect, remaining_tasks,
+)
 
 
 # Configure logging.
 LOGGER = logger_setup()
-# Init a counter variable.
-COUNTER = Value('i', 0)
+# ogr2ogr output patterns that indicate a copy has failed due to a nonstandard geometry type,
+# and the explicit geometry type to retry the copy with.
+FATAL_GEOMETRY_PATTERNS = [
+    (b'type Multi Surface', 'MULTIPOLYGON'),
+    (b'type Multi Curve', 'MULTILINESTRING'),
+]
 
 
 # Development environment: define variables in .env
@@ -18,97 +52,710 @@ if os.path.exists(dot_env):
     load_dotenv()
 
 
-def ingest_layer(data):
-    """This function expects to be passed a tuple containing (path, layer_name) pairs for
-    import to a PostgreSQL database using ogr2ogr.
+def get_ingest_backend():
+    """Returns the configured ingest backend: 'ogr2ogr' (default) or 'gdal'.
     """
-    file_gdb, layer_name = data[0], data[1]
-    pg_string = 'host={} user={} password={} dbname={}'.format(
-        os.getenv('DATABASE_HOST'),
-        os.getenv('DATABASE_USERNAME'),
-        os.getenv('DATABASE_PASSWORD'),
-        os.getenv('DATABASE_NAME'),
-    )
-    ogr2ogr_cmd = 'ogr2ogr -overwrite -f PostgreSQL PG:"{pg_string}" {file_gdb} {layer_name}'
-    LOGGER.info('Copying layer {}'.format(layer_name))
+    backend = os.getenv('INGEST_BACKEND', 'ogr2ogr').lower()
+    if backend not in ('ogr2ogr', 'gdal'):
+        raise ValueError('Unknown INGEST_BACKEND: {}'.format(backend))
+    return backend
+
+
+def ogr2ogr_command(file_gdb, layer_name, geometry_type=None, load_options=None, table=None, where=None, append=False):
+    """Returns the ogr2ogr command to copy a file GDB layer to the PostgreSQL database,
+    optionally with an explicit geometry type (-nlt) and a dict of load profile options.
+    For partitioned copies, the layer may be copied to a named table (-nln), limited to the
+    features matching a where clause (-where), and appended to an existing table with the
+    source FIDs preserved.
+    """
+    ogr2ogr_cmd = 'ogr2ogr {mode} {nlt}{profile}{partition}-f PostgreSQL PG:"{pg_string}" {file_gdb} {layer_name}'
+    mode = '-append -preserve_fid' if append else '-overwrite'
+    nlt = '-nlt {} '.format(geometry_type) if geometry_type else ''
+    profile_args = ogr2ogr_args(load_options) if load_options else ''
+    profile = '{} '.format(profile_args) if profile_args else ''
+    partition = '-nln {} '.format(table) if table else ''
+    if where:
+        partition += '-where "{}" '.format(where)
+    return ogr2ogr_cmd.format(
+        mode=mode, nlt=nlt, profile=profile, partition=partition, pg_string=get_pg_string(), file_gdb=file_gdb,
+        layer_name=layer_name)
+
+
+def run_ogr2ogr(cmd):
+    """Run an ogr2ogr command, streaming its output line by line. If the output shows that
+    the copy has failed due to a nonstandard geometry type, the process is terminated
+    immediately rather than left to run to completion.
+    Only a bounded number of the most recent output lines are retained, for logging.
+    Returns a tuple of (returncode, COPY failed (bool), retry geometry type or None,
+    [recent output lines]). ogr2ogr may exit 0 even though a COPY statement failed.
+    """
+    recent = deque(maxlen=int(os.getenv('OGR2OGR_LOG_LINES', 50)))
+    copy_failed = False
+    geometry_match = None
+    retry_type = None
+    proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in proc.stdout:
+        recent.append(line)
+        if b'COPY statement failed' in line:
+            copy_failed = True
+        if not geometry_match:
+            geometry_match = next((t for pattern, t in FATAL_GEOMETRY_PATTERNS if pattern in line), None)
+        if copy_failed and geometry_match:
+            retry_type = geometry_match
+            proc.terminate()
+            break
+    proc.stdout.close()
+    return proc.wait(), copy_failed, retry_type, list(recent)
+
+
+def ogr2ogr_copy(file_gdb, layer_name, geometry_type=None, load_options=None):
+    """Copy a single file GDB layer to the PostgreSQL database using an ogr2ogr subprocess,
+    optionally with an explicit geometry type (-nlt) and a dict of load profile options.
+    Returns a dict of copy statistics, or None if the copy failed.
+    """
+    start = time.time()
+    returncode, copy_failed, retry_type, output = run_ogr2ogr(
+        ogr2ogr_command(file_gdb, layer_name, geometry_type, load_options))
+
+    # NONSTANDARD GEOMETRY TYPE HANDLING
+    # The geometry type is normally detected before copying (see utils.get_layer_geometry_type),
+    # but the ogr2ogr copy operation might still fail due to the dataset geometry not matching
+    # one of the standard ones that the command expects (e.g. Multi Surface), even though the
+    # command would still return 0. In that case, the copy is aborted and retried with an
+    # explicit geometry type.
+    retry_reason = None
+    if retry_type and retry_type != geometry_type:
+        LOGGER.warning('Copy statement failed for {}, trying explicit geom type {}'.format(layer_name, retry_type))
+        retry_reason = 'COPY statement failed, retried as {}'.format(retry_type)
+        geometry_type = retry_type
+        returncode, copy_failed, retry_type, output = run_ogr2ogr(
+            ogr2ogr_command(file_gdb, layer_name, geometry_type, load_options))
 
+    # Any other COPY failure (e.g. an encoding error) means that features are missing.
+    if returncode != 0 or copy_failed:
+        LOGGER.error('ogr2ogr step failed for layer {} in {}:\n{}'.format(
+            layer_name, file_gdb, b''.join(output).decode(errors='replace')))
+        return
+
+    # ogr2ogr doesn't report a feature count.
+    return {
+        'layer': layer_name,
+        'features': None,
+        'elapsed': time.time() - start,
+        'geometry_type': geometry_type,
+        'retry_reason': retry_reason,
+    }
+
+
+def get_partition_count(file_gdb, layer_name):
+    """Returns a tuple of (partitions, features): the number of partitions to copy a layer in
+    (INGEST_PARTITIONS if the layer has at least INGEST_PARTITION_FEATURES features, otherwise
+    0 for a single copy), and its feature count.
+    """
+    threshold = int(os.getenv('INGEST_PARTITION_FEATURES', 0))
+    partitions = int(os.getenv('INGEST_PARTITIONS', 4))
+    # The staging table's index & sequence names must stay within PostgreSQL's 63 character
+    # limit on identifiers, to be renamed to those of the table.
+    if not threshold or partitions < 2 or len(launder(layer_name)) > 40:
+        return 0, None
     try:
-        cmd = ogr2ogr_cmd.format(pg_string=pg_string, file_gdb=file_gdb, layer_name=layer_name)
-        result = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+        features = get_layer_feature_count(file_gdb, layer_name)
     except subprocess.CalledProcessError:
-        LOGGER.exception('ogr2ogr step failed for layer {} in {}'.format(layer_name, file_gdb))
-        return
+        LOGGER.exception('ogrinfo feature count failed for layer {} in {}'.format(layer_name, file_gdb))
+        return 0, None
+    if not features or features < threshold:
+        return 0, features
+    return partitions, features
 
-    # NONSTANDARD GEOMETRY TYPE HANDLING
-    # The ogr2ogr copy operation might fail due to the dataset geometry not matching one of
-    # the standard ones that the command expects (e.g. Multi Surface), but the command still
-    # returns 0.
-    # Check the stdout content for indicators that the copy failed.
-    if b'COPY statement failed' in result and b'type Multi Surface' in result:
-        LOGGER.warning('Copy statement failed, geometry type Multi Surface, trying explicit geom type MULTIPOLYGON')
-        # Manually set the geometry type to MULTIPOLYGON:
-        cmd = 'ogr2ogr -overwrite -nlt MULTIPOLYGON -f PostgreSQL PG:"{}" {} {}'.format(
-            pg_string, file_gdb, layer_name)
-        try:
-            subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            LOGGER.exception('ogr2ogr step failed for layer {} in {}'.format(layer_name, file_gdb))
+
+def fid_partitions(features, partitions):
+    """Returns a list of where clauses splitting a layer's features into a number of FID ranges.
+    File GDB FIDs are numbered from 1, so the ranges are even unless features have been deleted.
+    The first and last ranges are open-ended, so that every feature is in exactly one range.
+    """
+    size = int(math.ceil(features / float(partitions)))
+    bounds = [1 + size * i for i in range(1, partitions)]
+    wheres = ['FID < {}'.format(bounds[0])]
+    wheres += ['FID >= {} AND FID < {}'.format(lower, upper) for lower, upper in zip(bounds, bounds[1:])]
+    wheres.append('FID >= {}'.format(bounds[-1]))
+    return wheres
+
+
+def partitioned_copy(file_gdb, layer_name, features, partitions, geometry_type=None, load_options=None):
+    """Copy a single large file GDB layer to the PostgreSQL database in FID range partitions,
+    loaded concurrently by ogr2ogr subprocesses into a staging table. The staging table is then
+    finalised as the layer's table (see db.finalise_staging_table), and indexed. Source FIDs are
+    preserved (as a single ogr2ogr copy does), so the resulting table is the same.
+    Returns a dict of copy statistics, or None if the copy failed.
+    """
+    start = time.time()
+    table = launder(layer_name)
+    staging = '{}_staging'.format(table)
+    schema = load_options['lco'].get('SCHEMA', 'public')
+
+    # Create the empty staging table, without a spatial index (which is created once loaded).
+    create_options = dict(load_options, lco=dict(load_options['lco'], SPATIAL_INDEX='NONE'))
+    # Until it is finalised, the staging table is dropped if the copy fails for any reason.
+    finalised = False
+    try:
+        returncode, _, _, output = run_ogr2ogr(
+            ogr2ogr_command(file_gdb, layer_name, geometry_type, create_options, staging, 'FID < 0'))
+        if returncode != 0:
+            LOGGER.error('ogr2ogr staging table creation failed for layer {} in {}:\n{}'.format(
+                layer_name, file_gdb, b''.join(output).decode(errors='replace')))
             return
-    elif b'COPY statement failed' in result and b'type Multi Curve' in result:
-        LOGGER.warning('Copy statement failed, geometry type Multi Curve, trying explicit geom type MULTILINESTRING')
-        # Manually set the geometry type to MULTILINESTRING:
-        cmd = 'ogr2ogr -overwrite -nlt MULTILINESTRING -f PostgreSQL PG:"{}" {} {}'.format(
-            pg_string, file_gdb, layer_name)
+
+        # Layer creation options (including SCHEMA) don't apply when appending, so the staging
+        # table name is qualified by its schema.
+        append_options = dict(load_options, lco={})
+        commands = [
+            ogr2ogr_command(
+                file_gdb, layer_name, geometry_type, append_options, '{}.{}'.format(schema, staging), where, append=True)
+            for where in fid_partitions(features, partitions)
+        ]
+        with ThreadPoolExecutor(max_workers=partitions) as executor:
+            results = list(executor.map(run_ogr2ogr, commands))
+        # A failed partition (including a COPY failure needing a geometry type retry) fails the whole copy.
+        failed = [output for returncode, copy_failed, _, output in results if returncode != 0 or copy_failed]
+        if failed:
+            LOGGER.error('ogr2ogr partition failed for layer {} in {}:\n{}'.format(
+                layer_name, file_gdb, b''.join(failed[0]).decode(errors='replace')))
+            return
+
+        conn = get_connection()
         try:
-            subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            LOGGER.exception('ogr2ogr step failed for layer {} in {}'.format(layer_name, file_gdb))
+            # Never replace the layer's table with an incomplete staging table.
+            loaded = count_rows(conn, staging, schema)
+            if loaded != features:
+                LOGGER.error('Partitioned copy of layer {} loaded {} of {} features'.format(layer_name, loaded, features))
+                return
+            finalise_staging_table(conn, staging, table, schema)
+            finalised = True
+            if load_options['lco'].get('SPATIAL_INDEX', 'GIST').upper() not in ('NONE', 'NO'):
+                create_spatial_index(conn, table, schema)
+        finally:
+            conn.close()
+    except psycopg2.Error:
+        if not finalised:
+            LOGGER.exception('Finalising partitioned copy failed for layer {}'.format(layer_name))
             return
+        LOGGER.exception('Spatial index creation failed for {}'.format(table))
+    finally:
+        if not finalised:
+            drop_staging_table(staging, schema)
+
+    return {
+        'layer': layer_name,
+        'features': features,
+        'elapsed': time.time() - start,
+        'geometry_type': geometry_type,
+        'retry_reason': None,
+        'partitions': partitions,
+    }
+
+
+def drop_staging_table(staging, schema):
+    try:
+        conn = get_connection()
+        drop_table(conn, staging, schema)
+        conn.close()
+    except psycopg2.Error:
+        LOGGER.exception('Failed to drop staging table {}'.format(staging))
+
+
+def preflight_geometry_type(manifest, file_gdb, layer_name, fingerprint):
+    """Returns the explicit geometry type to load a layer as (or None), reusing the decision
+    recorded in the manifest's type map if the source is unchanged.
+    """
+    geometry_type = get_geometry_type(manifest, file_gdb, layer_name, fingerprint)
+    if geometry_type is not None:
+        return geometry_type or None
+    scan_features = os.getenv('PREFLIGHT_SCAN_FEATURES', 'false').lower() == 'true'
+    try:
+        geometry_type = get_layer_geometry_type(file_gdb, layer_name, scan_features)
+    except subprocess.CalledProcessError:
+        LOGGER.exception('ogrinfo geometry inspection failed for layer {} in {}'.format(layer_name, file_gdb))
+        return None
+    if geometry_type:
+        LOGGER.info('Layer {} will be loaded as geometry type {}'.format(layer_name, geometry_type))
+    return geometry_type
+
+
+def postload_enabled():
+    return os.getenv('POSTLOAD_OPTIMISE', 'false').lower() == 'true'
+
+
+def postload_layer(db_pool, result):
+    """Post-load stage for a successfully-copied layer: ensure a spatial index exists, optionally
+    CLUSTER the table on it (POSTLOAD_CLUSTER), and ANALYZE the table. Timings are logged and
+    added to the layer's result record (or the error, if it fails).
+    """
+    cluster = os.getenv('POSTLOAD_CLUSTER', 'false').lower() == 'true'
+    start = time.time()
+    try:
+        timings = optimise_table(db_pool, result['table'], result['schema'], cluster)
+    except psycopg2.Error as e:
+        LOGGER.exception('Post-load optimisation failed for {}'.format(result['table']))
+        result['error'] = 'Post-load optimisation failed: {}'.format(e)
+        result['db_time'] += time.time() - start
+        return result
+    result['postload'] = timings
+    result['db_time'] += time.time() - start
+    LOGGER.info('Post-load optimisation of {} completed ({})'.format(
+        result['table'], ', '.join('{} {:.1f}s'.format(k, v) for k, v in timings.items())))
+    return result
+
+
+def new_record(file_gdb, layer_name, fingerprint=None):
+    """Returns a new result record dict for a layer, with a status of failed.
+    """
+    return {
+        'file_gdb': file_gdb,
+        'layer': layer_name,
+        'fingerprint': fingerprint,
+        'table': None,
+        'schema': None,
+        'status': 'failed',
+        'retry_reason': None,
+        'geometry_type': None,
+        'features': None,
+        'partitions': None,
+        'source_bytes': None,
+        'wall_time': None,
+        'copy_time': None,
+        'db_time': 0.0,
+        'error': None,
+    }
 
-    global COUNTER  # Couldn't work out how to do this without using a global var :|
-    with COUNTER.get_lock():
-        COUNTER.value += 1
-    LOGGER.info('Layer {} completed'.format(layer_name))
 
+def ingest_gdb_layer(manifest, file_gdb, layer_name, fingerprint, full=False, src=None, profile_config=None):
+    """Copy a single layer from a file GDB whose fingerprint has already been calculated,
+    unless the layer is unchanged (and full is False). The GDAL backend will reuse an already-
+    opened source datasource, if passed in. The load profile config may also be passed in,
+    rather than loaded for each layer.
+    Returns a result record dict for the layer, with a status of copied, skipped or failed.
+    """
+    start = time.time()
+    record = new_record(file_gdb, layer_name, fingerprint)
+    if not full and layer_unchanged(manifest, file_gdb, layer_name, fingerprint):
+        LOGGER.info('Layer {} unchanged, skipping'.format(layer_name))
+        record['status'] = 'skipped'
+        record['wall_time'] = time.time() - start
+        return record
+
+    geometry_type = preflight_geometry_type(manifest, file_gdb, layer_name, fingerprint)
+    load_options = get_load_options(layer_name, profile_config)
+    LOGGER.info('Copying layer {} (load profile {})'.format(layer_name, load_options['profile']))
+    if get_ingest_backend() == 'gdal':
+        result = gdal_ingest.copy_layer(file_gdb, layer_name, LOGGER, geometry_type, src, load_options)
+    else:
+        result = None
+        partitions, features = get_partition_count(file_gdb, layer_name)
+        if partitions:
+            LOGGER.info('Copying layer {} ({} features) in {} partitions'.format(layer_name, features, partitions))
+            result = partitioned_copy(file_gdb, layer_name, features, partitions, geometry_type, load_options)
+            if not result:
+                LOGGER.warning('Partitioned copy failed for layer {}, retrying as a single copy'.format(layer_name))
+        if not result:
+            result = ogr2ogr_copy(file_gdb, layer_name, geometry_type, load_options)
+    if not result:
+        record['wall_time'] = time.time() - start
+        return record
+
+    record.update({
+        'table': launder(layer_name),
+        'schema': load_options['lco'].get('SCHEMA', 'public'),
+        'status': 'copied',
+        'retry_reason': result['retry_reason'],
+        'geometry_type': result['geometry_type'],
+        'features': result['features'],
+        'partitions': result.get('partitions'),
+        'copy_time': result['elapsed'],
+    })
+    # If the spatial index was not created during the load, create it now (unless the
+    # post-load stage is enabled, which will do so).
+    if load_options['defer_index'] and not postload_enabled():
+        index_start = time.time()
+        try:
+            conn = get_connection()
+            create_spatial_index(conn, record['table'], record['schema'])
+            conn.close()
+        except psycopg2.Error:
+            LOGGER.exception('Spatial index creation failed for {}'.format(record['table']))
+        record['db_time'] += time.time() - index_start
+
+    record_layer(manifest, file_gdb, layer_name, fingerprint)
+    record_duration(manifest, file_gdb, layer_name, result['elapsed'])
+    # Store the geometry type decision (including any fallback retry) for reuse by later runs.
+    record_geometry_type(manifest, file_gdb, layer_name, fingerprint, result['geometry_type'])
+
+    if result['features'] is not None:
+        LOGGER.info('Layer {} completed ({} features in {:.1f}s)'.format(layer_name, result['features'], result['elapsed']))
+    else:
+        LOGGER.info('Layer {} completed ({:.1f}s)'.format(layer_name, result['elapsed']))
+    record['wall_time'] = time.time() - start
+    return record
+
+
+def ingest_gdb(batch, full=False):
+    """This function expects to be passed a tuple of (path, [layer_name, ...], fingerprint) for
+    import to a PostgreSQL database, using either ogr2ogr or the GDAL Python bindings (set by the
+    INGEST_BACKEND environment variable). The fingerprint of the file GDB, as calculated when the
+    batch was scheduled, is optional (otherwise the file GDB is fingerprinted once for all of the
+    layers in the batch). For the GDAL backend, the file GDB is opened once for the batch.
+    Layers whose source file GDB is unchanged since the last successful copy are skipped,
+    unless full is True.
+    Returns a list of result record dicts.
+    """
+    file_gdb, layer_names = batch[0], batch[1]
+    fingerprint = batch[2] if len(batch) > 2 else None
+    # An unexpected error fails only the layer (or the batch, before any layer is copied), rather
+    # than the whole run.
+    try:
+        # Fingerprint the source before copying, so that changes made during the copy are picked up next run.
+        if fingerprint is None:
+            fingerprint = gdb_fingerprints([batch])[file_gdb]
+        src = gdal_ingest.open_source(file_gdb) if get_ingest_backend() == 'gdal' else None
+        profile_config = load_profile_config()
+    except Exception as e:
+        LOGGER.exception('Ingest failed for {}'.format(file_gdb))
+        results = [new_record(file_gdb, layer_name) for layer_name in layer_names]
+        for record in results:
+            record['error'] = str(e)
+        return results
+
+    manifest = manifest_connect()
+    results = []
+    for layer_name in layer_names:
+        try:
+            record = ingest_gdb_layer(manifest, file_gdb, layer_name, fingerprint, full, src, profile_config)
+        except Exception as e:
+            LOGGER.exception('Ingest failed for layer {} in {}'.format(layer_name, file_gdb))
+            record = new_record(file_gdb, layer_name, fingerprint)
+            record['error'] = str(e)
+        results.append(record)
+    manifest.close()
+    return results
 
-def mp_handler(cddp_path=None):
+
+def ingest_layer(data, full=False):
+    """This function expects to be passed a tuple containing (path, layer_name, fingerprint)
+    for import to a PostgreSQL database (see ingest_gdb; the fingerprint is optional).
+    Returns a result record dict.
+    """
+    file_gdb, layer_name = data[0], data[1]
+    fingerprint = data[2] if len(data) > 2 else None
+    return ingest_gdb((file_gdb, [layer_name], fingerprint), full)[0]
+
+
+def checkpoint(run_id, record, future=None):
+    """Record a layer's outcome in the checkpoint journal: done if it was skipped, or copied (and
+    optimised, if its post-load stage future is passed in) without error, otherwise failed.
+    """
+    if future and future.exception():
+        record['error'] = str(future.exception())
+    if record['status'] == 'failed' or record['error']:
+        record_failed('ingest', run_id, record['file_gdb'], record['layer'], record['error'])
+    else:
+        record_done('ingest', run_id, record['file_gdb'], record['layer'], record['fingerprint'])
+
+
+def mp_handler(cddp_path=None, full=False, resume=False, shard=None):
     """Multiprocessing handler to import file GDBs from the mounted CDDP volume.
+    Pass full=True to copy every layer, regardless of the change manifest.
+    Pass resume=True to continue an interrupted run, skipping layers that it already completed
+    from an unchanged source.
+    Pass shard=(index, count) to copy only one shard of the CDDP's layers (see
+    scheduler.shard_datasets), e.g. with each shard run by a different node.
     """
     if not cddp_path:
         # Assume that this path set via an environment variable if not explicitly passed in.
         cddp_path = os.getenv('CDDP_PATH')
 
+    batch_by_gdb = os.getenv('INGEST_BATCH_BY_GDB', 'false').lower() == 'true'
     datasets = parse_cddp(cddp_path, LOGGER)
+    if shard:
+        # Keep file GDBs whole when batching by GDB, so that each GDB is only opened by one node.
+        total = len(datasets)
+        datasets = shard_datasets(datasets, shard[0], shard[1], batch_by_gdb)
+        LOGGER.info('Shard {}/{}: {} of {} layers'.format(shard[0], shard[1], len(datasets), total))
+    # Each completed layer is recorded in the checkpoint journal.
+    run_id, completed = start_run('ingest', resume)
+    # Fingerprint each file GDB once, here, for the resume check, scheduling and every layer task.
+    fingerprints = gdb_fingerprints(datasets)
+    if completed:
+        remaining = [d for d in datasets if completed.get(d) != fingerprints[d[0]]]
+        LOGGER.info('Resuming interrupted run: {} layers already completed'.format(len(datasets) - len(remaining)))
+        datasets = remaining
     LOGGER.info('{} layers scheduled for copying from file GDB'.format(len(datasets)))
 
+    # Estimate the cost of each layer and dispatch the most costly first, so that large layers
+    # don't end up running alone at the end of the job.
+    manifest = manifest_connect()
+    source_bytes = get_source_bytes(datasets)
+    costs = estimate_costs(datasets, manifest, full, source_bytes, fingerprints)
+    manifest.close()
+    workers = get_worker_count()
+    if batch_by_gdb:
+        # Group layers by file GDB, so that each GDB is opened once per worker.
+        batches, batch_costs = batch_datasets(datasets, costs, workers)
+        LOGGER.info('{} layers grouped into {} file GDB batches'.format(len(datasets), len(batches)))
+        predicted = predict_makespan(batch_costs, workers)
+    else:
+        predicted = predict_makespan(sorted(costs.values(), reverse=True), workers)
+    LOGGER.info('Predicted makespan {:.0f}s using {} workers (discovery order: {:.0f}s)'.format(
+        predicted, workers, predict_static_makespan([costs[d] for d in datasets], workers)))
+    start = time.time()
+
     # Use a multiprocessing Pool to ingest datasets in parallel.
-    p = Pool(processes=4)
-    p.map(ingest_layer, datasets)
-    LOGGER.info('{}/{} layers successfully copied'.format(COUNTER.value, len(datasets)))
+    if get_ingest_backend() == 'gdal':
+        gdal_ingest.check_bindings()
+        # Each worker process holds open a single database connection for all of its layers.
+        p = Pool(processes=workers, initializer=gdal_ingest.init_worker)
+    else:
+        p = Pool(processes=workers)
+    if batch_by_gdb:
+        batches = [(file_gdb, layer_names, fingerprints[file_gdb]) for file_gdb, layer_names in batches]
+        tasks = p.imap_unordered(partial(ingest_gdb, full=full), batches, chunksize=1)
+    else:
+        scheduled = [(file_gdb, layer_name, fingerprints[file_gdb]) for file_gdb, layer_name in schedule(datasets, costs)]
+        tasks = p.imap_unordered(partial(ingest_layer, full=full), scheduled, chunksize=1)
+    # The optional post-load stage runs in threads of this process using its own bounded
+    # connection pool, so that finished layers are optimised while other copies continue.
+    if postload_enabled():
+        postload_workers = int(os.getenv('POSTLOAD_WORKERS', 2))
+        db_pool = get_connection_pool(postload_workers)
+        postload = ThreadPoolExecutor(max_workers=postload_workers)
+    records = []
+    for results in tasks:
+        if not batch_by_gdb:
+            results = [results]
+        for record in results:
+            record['source_bytes'] = source_bytes[(record['file_gdb'], record['layer'])]
+            records.append(record)
+            if record['status'] == 'copied' and postload_enabled():
+                # The post-load stage updates the record in-place. The layer is complete once it finishes.
+                future = postload.submit(postload_layer, db_pool, record)
+                future.add_done_callback(partial(checkpoint, run_id, record))
+            else:
+                checkpoint(run_id, record)
+    p.close()
+    p.join()
+    if postload_enabled():
+        postload.shutdown(wait=True)
+        db_pool.closeall()
+    finished = time.time()
+    finish_run('ingest', run_id)
+
+    summary = summarise(records)
+    LOGGER.info('{}/{} layers successfully copied'.format(summary['copied'], len(datasets)))
+    LOGGER.info('{} unchanged layers skipped, {} layers failed'.format(summary['skipped'], summary['failed']))
+    LOGGER.info('Actual makespan {:.0f}s (predicted {:.0f}s)'.format(finished - start, predicted))
+    report_path = os.getenv('REPORT_PATH', get_state_path('ingest_report.json'))
+    write_json_report(records, report_path, start, finished)
+    LOGGER.info('Run report written to {}'.format(report_path))
+    if os.getenv('PROMETHEUS_TEXTFILE_PATH'):
+        write_prometheus_textfile(records, os.getenv('PROMETHEUS_TEXTFILE_PATH'), start, finished)
+    return records
+
+
+def enqueue_cddp(cddp_path=None, full=False):
+    """Discover the layers in the mounted CDDP volume and add them to the work queue in the
+    PostgreSQL database, for copying by queue workers on any number of nodes (see queue_worker).
+    Each file GDB is fingerprinted once, here, and layers are claimed most costly first.
+    Returns the run ID.
+    """
+    if not cddp_path:
+        cddp_path = os.getenv('CDDP_PATH')
+
+    datasets = parse_cddp(cddp_path, LOGGER)
+    fingerprints = gdb_fingerprints(datasets)
+    manifest = manifest_connect()
+    costs = estimate_costs(datasets, manifest, full, fingerprints=fingerprints)
+    manifest.close()
+    run_id = uuid.uuid4().hex
+    conn = queue_connect()
+    enqueue_tasks(conn, run_id, [(d[0], d[1], fingerprints[d[0]], costs[d]) for d in datasets], full)
+    conn.close()
+    LOGGER.info('{} layers queued for copying (run {})'.format(len(datasets), run_id))
+    return run_id
+
+
+def queue_worker(index=None):
+    """Queue worker loop, run by each worker process: claim layers from the work queue and copy
+    them until none remain. A heartbeat thread extends the leases on claimed layers, so that
+    the layers of a worker which has crashed are claimed by another once their leases expire.
+    While other workers still hold claimed layers, poll every INGEST_QUEUE_POLL seconds.
+    Unchanged layers are skipped using the fingerprints in the queue table (rather than this
+    node's change manifest), so that a layer copied by any node is skipped by every node.
+    Returns a list of result records.
+    """
+    worker = get_worker_id()
+    conn = queue_connect()
+    heartbeat = LeaseHeartbeat(worker, LOGGER)
+    heartbeat.start()
+    db_pool = get_connection_pool(1) if postload_enabled() else None
+    poll = float(os.getenv('INGEST_QUEUE_POLL', 10))
+    records = []
+    try:
+        while True:
+            task = claim_task(conn, worker)
+            if not task:
+                if not remaining_tasks(conn):
+                    break
+                time.sleep(poll)
+                continue
+            file_gdb, layer_name = task['file_gdb'], task['layer_name']
+            if not task['full_copy'] and task['fingerprint'] == task['copied_fingerprint']:
+                LOGGER.info('Layer {} unchanged, skipping'.format(layer_name))
+                record = new_record(file_gdb, layer_name, task['fingerprint'])
+                record.update({'status': 'skipped', 'wall_time': 0.0})
+            else:
+                # The layer is known to need copying, so bypass this node's change manifest.
+                record = ingest_gdb((file_gdb, [layer_name], task['fingerprint']), full=True)[0]
+            if record['status'] == 'copied' and db_pool:
+                postload_layer(db_pool, record)
+            record['worker'] = worker
+            status = 'failed' if record['status'] == 'failed' else 'done'
+            copied = record['status'] == 'copied'
+            if not complete_task(conn, worker, file_gdb, layer_name, status, record, copied):
+                LOGGER.warning('Lease on layer {} expired before it was completed'.format(layer_name))
+            records.append(record)
+    finally:
+        heartbeat.stop()
+        if db_pool:
+            db_pool.closeall()
+        conn.close()
+    return records
+
+
+def run_queue_workers():
+    """Run INGEST_WORKERS queue worker processes on this node (see queue_worker), until the
+    work queue has been drained. Returns a list of the result records of this node's layers.
+    """
+    workers = get_worker_count()
+    LOGGER.info('Starting {} queue workers'.format(workers))
+    if get_ingest_backend() == 'gdal':
+        gdal_ingest.check_bindings()
+        p = Pool(processes=workers, initializer=gdal_ingest.init_worker)
+    else:
+        p = Pool(processes=workers)
+    records = [record for results in p.map(queue_worker, range(workers)) for record in results]
+    p.close()
+    p.join()
+    summary = summarise(records)
+    LOGGER.info('{} layers copied by this node, {} unchanged layers skipped, {} layers failed'.format(
+        summary['copied'], summary['skipped'], summary['failed']))
+    return records
+
+
+def collect_queue_run(run_id, start):
+    """Wait until the work queue has been drained, then write the run report for all of the
+    layers copied by every node in a queued run. Returns the list of result records.
+    """
+    conn = queue_connect()
+    poll = float(os.getenv('INGEST_QUEUE_POLL', 10))
+    while remaining_tasks(conn):
+        time.sleep(poll)
+    # Tasks failed on lease expiry have only a partial result record.
+    records = [dict(new_record(r['file_gdb'], r['layer']), **r) for r in get_results(conn, run_id)]
+    conn.close()
+    finished = time.time()
+
+    source_bytes = get_source_bytes([(r['file_gdb'], r['layer']) for r in records])
+    for record in records:
+        record['source_bytes'] = source_bytes[(record['file_gdb'], record['layer'])]
+    summary = summarise(records)
+    LOGGER.info('{}/{} layers successfully copied'.format(summary['copied'], len(records)))
+    LOGGER.info('{} unchanged layers skipped, {} layers failed'.format(summary['skipped'], summary['failed']))
+    LOGGER.info('Queued run completed in {:.0f}s'.format(finished - start))
+    report_path = os.getenv('REPORT_PATH', get_state_path('ingest_report.json'))
+    write_json_report(records, report_path, start, finished)
+    LOGGER.info('Run report written to {}'.format(report_path))
+    if os.getenv('PROMETHEUS_TEXTFILE_PATH'):
+        write_prometheus_textfile(records, os.getenv('PROMETHEUS_TEXTFILE_PATH'), start, finished)
+    return records
+
+
+def publish_one(workspace, datastore, featuretype):
+    """Publish a single featuretype. Returns a result dict of the status (published or failed),
+    the number of request retries made by the GeoServer client, elapsed time and any error.
+    """
+    start = time.time()
+    result = {'featuretype': featuretype, 'status': 'failed', 'retries': 0, 'elapsed': None, 'error': None}
+    try:
+        r = publish_featuretype(workspace, datastore, featuretype)
+        result['status'] = 'published'
+        if r.raw is not None and r.raw.retries is not None:
+            result['retries'] = len(r.raw.retries.history)
+    except Exception as e:
+        result['error'] = str(e)
+    result['elapsed'] = time.time() - start
+    return result
 
 
-def publish_featuretypes(blacklist=[]):
+def publish_featuretypes(blacklist=[], include=None):
     """Function to check if any new featuretypes are present and can be published.
-    The blacklist is an optional list of strings of table names to not publish.
+    The blacklist is an optional list of strings of table names to not publish. If include is
+    passed, only table names in that list are published (e.g. the layers copied by this node).
+    Featuretypes are published concurrently, up to a limit set by PUBLISH_WORKERS.
+    Returns a list of result dicts (see publish_one).
     """
     workspace = os.getenv('GEOSERVER_WORKSPACE')
     datastore = os.getenv('GEOSERVER_DATASTORE')
     LOGGER.info('Checking for any new feature types to publish')
     featuretypes = get_available_featuretypes(workspace, datastore)
-    count = 0
-
-    for ft in featuretypes:
-        if not ft.startswith('pg_') and ft not in blacklist:  # Skip any Postgres system tables, and blacklisted ones.
-            try:
-                publish_featuretype(workspace, datastore, ft)
-                LOGGER.info('Published featuretype {}'.format(ft))
-                count += 1
-            except:
-                continue
+    # Skip any Postgres system tables, staging tables of partitioned copies, and blacklisted ones.
+    featuretypes = [
+        ft for ft in featuretypes if not ft.startswith('pg_') and not ft.endswith('_staging') and ft not in blacklist
+    ]
+    if include is not None:
+        featuretypes = [ft for ft in featuretypes if ft in include]
+    results = []
+
+    with ThreadPoolExecutor(max_workers=int(os.getenv('PUBLISH_WORKERS', 4))) as executor:
+        futures = [executor.submit(publish_one, workspace, datastore, ft) for ft in featuretypes]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result['status'] == 'published':
+                LOGGER.info('Published featuretype {} ({:.1f}s, {} retries)'.format(
+                    result['featuretype'], result['elapsed'], result['retries']))
+            else:
+                LOGGER.error('Failed to publish featuretype {}: {}'.format(result['featuretype'], result['error']))
 
-    LOGGER.info('{} new featuretypes were published'.format(count))
+    published = [r for r in results if r['status'] == 'published']
+    LOGGER.info('{} new featuretypes were published, {} failed, {} retried'.format(
+        len(published), len(results) - len(published), sum(1 for r in results if r['retries'])))
+    return results
 
 
 if __name__ == "__main__":
-    mp_handler()
-    publish_featuretypes()
+    parser = argparse.ArgumentParser(description='Copy file GDB layers from the CDDP to a PostgreSQL database')
+    parser.add_argument('--full', action='store_true', help='Copy all layers, including those unchanged since the last run')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted run, skipping layers it already completed')
+    parser.add_argument('--shard', metavar='i/N', help='Copy only shard i (from 0) of N of the layers')
+    parser.add_argument('--enqueue', action='store_true', help='Queue layers in the database work queue, and report once it is drained')
+    parser.add_argument('--worker', action='store_true', help='Copy layers claimed from the database work queue')
+    args = parser.parse_args()
+    if args.enqueue or args.worker:
+        if args.shard or args.resume:
+            parser.error('--shard and --resume cannot be used with the work queue')
+        start = time.time()
+        run_id = enqueue_cddp(full=args.full) if args.enqueue else None
+        records = run_queue_workers() if args.worker else []
+        if run_id:
+            collect_queue_run(run_id, start)
+        if args.worker:
+            # Each node publishes the featuretypes for the layers that it copied.
+            publish_featuretypes(include=[launder(r['layer']) for r in records if r['status'] != 'failed'])
+    elif args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        records = mp_handler(full=args.full, resume=args.resume, shard=shard)
+        publish_featuretypes(include=[launder(r['layer']) for r in records if r['status'] != 'failed'])
+    else:
+        mp_handler(full=args.full, resume=args.resume)
+        publish_featuretypes()
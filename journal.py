@@ -0,0 +1,130 @@
+from datetime import datetime, timezone
+import fcntl
+import json
+import os
+import uuid
+
+from utils import get_state_path
+
+
+def get_journal_path():
+    return os.getenv('JOURNAL_PATH', get_state_path('journal.jsonl'))
+
+
+def append_entry(entry, journal_path=None):
+    """Append a single entry (dict) to the journal, as one line of JSON. Entries are only ever
+    appended, so that a run that is killed part-way through leaves a usable journal.
+    """
+    entry['at'] = datetime.now(timezone.utc).isoformat()
+    line = '{}\n'.format(json.dumps(entry))
+    # A single small write to a file opened for appending is not interleaved with writes by
+    # other processes. The lock excludes compaction (see compact_journal).
+    with open(journal_path or get_journal_path(), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_entries(journal_path=None):
+    """Returns a list of all journal entries. An incomplete final line (from a process killed
+    mid-write) is ignored.
+    """
+    journal_path = journal_path or get_journal_path()
+    if not os.path.exists(journal_path):
+        return []
+    with open(journal_path) as f:
+        return parse_entries(f)
+
+
+def parse_entries(lines):
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            continue
+    return entries
+
+
+def interrupted_run(job, journal_path=None):
+    """Returns the run ID of the most recent run of a job ('ingest' or 'metadata'), if that run
+    did not finish. Otherwise returns None.
+    """
+    run_id = None
+    for entry in read_entries(journal_path):
+        if entry.get('job') != job:
+            continue
+        if entry['event'] == 'start':
+            run_id = entry['run_id']
+        elif entry['event'] == 'finish' and entry['run_id'] == run_id:
+            run_id = None
+    return run_id
+
+
+def start_run(job, resume=False, journal_path=None):
+    """Start a run of a job, returning a tuple of (run_id, completed), where completed is a dict
+    of {(file_gdb, layer_name): fingerprint} for each layer already completed by the run.
+    If resume is True and the job's most recent run did not finish, that run is continued (and
+    its completed layers returned). Otherwise a new run is started.
+    """
+    run_id = interrupted_run(job, journal_path) if resume else None
+    completed = {}
+    if run_id:
+        for entry in read_entries(journal_path):
+            if entry.get('run_id') == run_id and entry['event'] == 'done':
+                completed[(entry['file_gdb'], entry['layer'])] = entry['fingerprint']
+    else:
+        run_id = uuid.uuid4().hex
+        append_entry({'job': job, 'run_id': run_id, 'event': 'start'}, journal_path)
+    return run_id, completed
+
+
+def record_done(job, run_id, file_gdb, layer_name, fingerprint, journal_path=None):
+    """Record that a layer has been completed by a run, from a source with the given fingerprint.
+    """
+    append_entry({
+        'job': job, 'run_id': run_id, 'event': 'done', 'file_gdb': file_gdb, 'layer': layer_name,
+        'fingerprint': fingerprint,
+    }, journal_path)
+
+
+def record_failed(job, run_id, file_gdb, layer_name, error=None, journal_path=None):
+    """Record that a run failed to complete a layer (a resumed run will try it again).
+    """
+    append_entry({
+        'job': job, 'run_id': run_id, 'event': 'failed', 'file_gdb': file_gdb, 'layer': layer_name, 'error': error,
+    }, journal_path)
+
+
+def finish_run(job, run_id, journal_path=None):
+    """Record that a run has finished, then compact the journal.
+    """
+    append_entry({'job': job, 'run_id': run_id, 'event': 'finish'}, journal_path)
+    compact_journal(journal_path)
+
+
+def compact_journal(journal_path=None):
+    """Rewrite the journal keeping only the entries of each job's most recent run, if that run
+    has not finished (only such a run can be resumed), so that the journal does not grow
+    without limit. The journal is rewritten in place while locked, so that entries appended
+    concurrently by another job's run are not lost.
+    """
+    journal_path = journal_path or get_journal_path()
+    if not os.path.exists(journal_path):
+        return
+    with open(journal_path, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        entries = parse_entries(f)
+        latest = {}
+        for entry in entries:
+            if entry['event'] == 'start':
+                latest[entry.get('job')] = entry['run_id']
+            elif entry['event'] == 'finish' and latest.get(entry.get('job')) == entry['run_id']:
+                del latest[entry.get('job')]
+        keep = set(latest.values())
+        f.seek(0)
+        f.writelines('{}\n'.format(json.dumps(entry)) for entry in entries if entry.get('run_id') in keep)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
@@ -0,0 +1,76 @@
+from datetime import datetime, timezone
+import os
+import statistics
+
+from utils import state_connect
+
+
+def latency_connect(db_path=None):
+    """Open (and create, if required) the SQLite store of per-layer monitoring latencies.
+    Returns a connection object.
+    """
+    return state_connect('latency.sqlite', [
+        # One row per layer per monitoring run; mode is 'wmts' (tile) or 'wms' (GetMap).
+        '''CREATE TABLE IF NOT EXISTS samples (
+            run_at TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            layer_name TEXT NOT NULL,
+            ok INTEGER NOT NULL,
+            ttfb REAL,
+            total REAL
+        )''',
+        'CREATE INDEX IF NOT EXISTS samples_layer_idx ON samples (mode, layer_name, run_at)',
+    ], db_path or os.getenv('LATENCY_DB_PATH'))
+
+
+def get_baseline(conn, mode, layer_name, runs=None, min_samples=None):
+    """Returns the baseline total latency for a layer: the median of its most recent successful
+    samples (up to LATENCY_BASELINE_RUNS), or None if there are fewer than
+    LATENCY_BASELINE_MIN_SAMPLES of them.
+    """
+    runs = runs or int(os.getenv('LATENCY_BASELINE_RUNS', 10))
+    min_samples = min_samples or int(os.getenv('LATENCY_BASELINE_MIN_SAMPLES', 3))
+    rows = conn.execute(
+        'SELECT total FROM samples WHERE mode = ? AND layer_name = ? AND ok = 1 ORDER BY run_at DESC LIMIT ?',
+        (mode, layer_name, runs),
+    ).fetchall()
+    if len(rows) < min_samples:
+        return None
+    return statistics.median(row[0] for row in rows)
+
+
+def record_samples(conn, mode, results, run_at=None):
+    """Record the results of a monitoring run (see monitor.probe).
+    """
+    if not run_at:
+        run_at = datetime.now(timezone.utc).isoformat()
+    with conn:
+        conn.executemany(
+            'INSERT INTO samples (run_at, mode, layer_name, ok, ttfb, total) VALUES (?, ?, ?, ?, ?, ?)',
+            [(run_at, mode, r['layer'], int(r['ok']), r['ttfb'], r['total']) for r in results],
+        )
+
+
+def detect_regressions(conn, mode, results, factor=None, min_delta=None):
+    """Compare the results of a monitoring run against each layer's baseline (which must be
+    done before the run is recorded). A layer has regressed where its total latency exceeds the
+    baseline by more than LATENCY_REGRESSION_FACTOR times, and by at least
+    LATENCY_REGRESSION_MIN_SECONDS. Sets 'baseline' and 'regressed' on each result dict, and
+    returns a list of dicts describing the regressed layers.
+    """
+    factor = factor or float(os.getenv('LATENCY_REGRESSION_FACTOR', 3))
+    min_delta = min_delta if min_delta is not None else float(os.getenv('LATENCY_REGRESSION_MIN_SECONDS', 0.5))
+    regressions = []
+    for r in results:
+        r['baseline'] = get_baseline(conn, mode, r['layer'])
+        r['regressed'] = bool(
+            r['ok'] and r['baseline'] and r['total'] > r['baseline'] * factor and r['total'] - r['baseline'] >= min_delta
+        )
+        if r['regressed']:
+            regressions.append({
+                'layer': r['layer'],
+                'total': r['total'],
+                'baseline': r['baseline'],
+                'ratio': r['total'] / r['baseline'],
+            })
+    return sorted(regressions, key=lambda i: i['ratio'], reverse=True)
@@ -0,0 +1,124 @@
+from datetime import datetime, timezone
+import hashlib
+import os
+
+from utils import state_connect
+
+
+def content_hash_enabled():
+    # Whether file GDB fingerprints also hash the table contents (see gdb_fingerprint).
+    return os.getenv('MANIFEST_CONTENT_HASH', 'false').lower() == 'true'
+
+
+def gdb_fingerprint(file_gdb, content_hash=None):
+    """For a given file GDB path, return a fingerprint string derived from the name, size and
+    modification time of each of the .gdbtable files within it. If content_hash is True
+    (default: the MANIFEST_CONTENT_HASH setting), the contents of each file are also hashed
+    (slower, but robust against preserved mtimes).
+    """
+    if content_hash is None:
+        content_hash = content_hash_enabled()
+    h = hashlib.sha1()
+    tables = sorted((i for i in os.scandir(file_gdb) if i.name.endswith('.gdbtable')), key=lambda i: i.name)
+    for entry in tables:
+        stat = entry.stat()
+        h.update('{}|{}|{}\n'.format(entry.name, stat.st_size, stat.st_mtime_ns).encode())
+        if content_hash:
+            with open(entry.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+def gdb_fingerprints(datasets):
+    """For a list of (file_gdb, layer_name) tuples, returns a dict of {file_gdb: fingerprint},
+    fingerprinting each file GDB once (see gdb_fingerprint).
+    """
+    content_hash = content_hash_enabled()
+    return {file_gdb: gdb_fingerprint(file_gdb, content_hash) for file_gdb in set(d[0] for d in datasets)}
+
+
+def manifest_connect(manifest_path=None):
+    """Open (and create, if required) the SQLite change manifest. Returns a connection object.
+    """
+    return state_connect('manifest.sqlite', [
+        '''CREATE TABLE IF NOT EXISTS layers (
+            file_gdb TEXT NOT NULL,
+            layer_name TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            copied_at TEXT NOT NULL,
+            PRIMARY KEY (file_gdb, layer_name)
+        )''',
+        # Per-layer map of the explicit geometry type chosen to load each layer ('' for none).
+        '''CREATE TABLE IF NOT EXISTS geometry_types (
+            file_gdb TEXT NOT NULL,
+            layer_name TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            geometry_type TEXT NOT NULL,
+            PRIMARY KEY (file_gdb, layer_name)
+        )''',
+        # Per-layer copy duration from the most recent successful run, used for scheduling.
+        '''CREATE TABLE IF NOT EXISTS durations (
+            file_gdb TEXT NOT NULL,
+            layer_name TEXT NOT NULL,
+            elapsed REAL NOT NULL,
+            PRIMARY KEY (file_gdb, layer_name)
+        )''',
+    ], manifest_path or os.getenv('MANIFEST_PATH'))
+
+
+def layer_unchanged(conn, file_gdb, layer_name, fingerprint):
+    """Returns True if the manifest records that the layer was last copied with an identical
+    source fingerprint.
+    """
+    row = conn.execute(
+        'SELECT fingerprint FROM layers WHERE file_gdb = ? AND layer_name = ?', (file_gdb, layer_name)
+    ).fetchone()
+    return row is not None and row[0] == fingerprint
+
+
+def record_layer(conn, file_gdb, layer_name, fingerprint):
+    """Record the source fingerprint of a successfully-copied layer in the manifest.
+    """
+    conn.execute(
+        'INSERT OR REPLACE INTO layers (file_gdb, layer_name, fingerprint, copied_at) VALUES (?, ?, ?, ?)',
+        (file_gdb, layer_name, fingerprint, datetime.now(timezone.utc).isoformat()),
+    )
+    conn.commit()
+
+
+def get_geometry_type(conn, file_gdb, layer_name, fingerprint):
+    """Returns the recorded explicit geometry type for a layer ('' if none is required), or None if
+    no decision has been recorded for the current source fingerprint.
+    """
+    row = conn.execute(
+        'SELECT geometry_type FROM geometry_types WHERE file_gdb = ? AND layer_name = ? AND fingerprint = ?',
+        (file_gdb, layer_name, fingerprint),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def record_geometry_type(conn, file_gdb, layer_name, fingerprint, geometry_type):
+    """Record the explicit geometry type used to load a layer (None or '' for none).
+    """
+    conn.execute(
+        'INSERT OR REPLACE INTO geometry_types (file_gdb, layer_name, fingerprint, geometry_type) VALUES (?, ?, ?, ?)',
+        (file_gdb, layer_name, fingerprint, geometry_type or ''),
+    )
+    conn.commit()
+
+
+def get_durations(conn):
+    """Returns a dict of {(file_gdb, layer_name): elapsed seconds} for previously-copied layers.
+    """
+    return {(row[0], row[1]): row[2] for row in conn.execute('SELECT file_gdb, layer_name, elapsed FROM durations')}
+
+
+def record_duration(conn, file_gdb, layer_name, elapsed):
+    """Record how long a layer took to copy.
+    """
+    conn.execute(
+        'INSERT OR REPLACE INTO durations (file_gdb, layer_name, elapsed) VALUES (?, ?, ?)',
+        (file_gdb, layer_name, elapsed),
+    )
+    conn.commit()
@@ -1,84 +1,240 @@
+import argparse
 from multiprocessing import Pool
 import os
 
-from gdb_utils import get_metadata, get_abstract, get_title, update_resource, convert_qml
-from utils import logger_setup, parse_cddp_qmls, get_layers, create_style, set_layer_style
+from gdb_utils import reconcile_resource, convert_qml, init_qgis, get_converter_version, qgis_available
+from journal import start_run, record_done, record_failed, finish_run
+from manifest import gdb_fingerprint, gdb_fingerprints
+from metadata_cache import get_gdb_metadata
+from qml2sld import translate_qml, UnsupportedQml
+from sld_cache import sld_cache_connect, style_key, get_sld, store_sld, is_uploaded, record_upload
+from utils import logger_setup, parse_cddp_qmls, get_layers, get_catalog_snapshot, create_style, set_layer_style
 
 
 # Configure logging.
 LOGGER = logger_setup()
+# Dict of published layers and their URLs, set in each worker process by init_worker.
+LAYERS = None
+# The checkpoint journal run ID, set in each worker process by init_worker.
+RUN_ID = None
 
 
-def update_metadata(dataset, layers):
+def get_qml_translator():
+    """Returns the QML to SLD translator to use: 'native' (default; QGIS is used only for
+    styles that the native translator does not support) or 'qgis'.
+    """
+    return os.getenv('QML_TRANSLATOR', 'native').lower()
+
+
+def check_qml_translator():
+    """Validate the QML to SLD translator before any worker processes are started, as a Pool
+    worker whose initializer fails is replaced (and fails again) indefinitely. Raises ValueError
+    for an unknown translator, or ImportError if 'qgis' is set but QGIS is not installed.
+    """
+    translator = get_qml_translator()
+    if translator not in ['native', 'qgis']:
+        raise ValueError('Unknown QML_TRANSLATOR (expected native or qgis): {}'.format(translator))
+    if translator == 'qgis' and not qgis_available():
+        raise ImportError('QML_TRANSLATOR is qgis, but the QGIS Python bindings (qgis.core) are not installed')
+
+
+def build_sld(gdb_path, layer_name, qml_path):
+    """Build an SLD for a layer from its QML file, using the native translator where possible
+    and falling back to QGIS. Returns the XML string, or None on failure.
+    """
+    if get_qml_translator() == 'native':
+        try:
+            return translate_qml(qml_path, layer_name)
+        except UnsupportedQml as e:
+            LOGGER.info('Converting style for {} using QGIS: {}'.format(layer_name, e))
+    return convert_qml(gdb_path, layer_name, qml_path, LOGGER)
+
+
+def find_record(records, layer):
+    """Returns the metadata record for a layer from a dict of {layer_name: record} (matching
+    layer names case-insensitively), or None.
+    """
+    for layer_name, record in records.items():
+        if layer_name.lower() == layer.lower():
+            return record
+    return None
+
+
+def update_metadata(dataset, layers, record=None):
     """Utility script to update the metadata for all the published layers in a given file GDB.
     This script also publishes styles for each layer, on the assumption that a compatible QML
-    file named <layer>.qml is present.
+    file named <layer>.qml is present (pass a qml_path of None to update metadata only).
+    The layer's parsed metadata record (see metadata_cache.get_gdb_metadata) may be passed in.
+    Returns True if the updates succeeded (or the layer isn't published), otherwise False.
     """
     gdb_path, layer, qml_path = dataset
     layer_name = layer.lower()
     workspace = os.getenv('GEOSERVER_WORKSPACE')
-    # For a given dataset, find out if it is published. If so, parse the metadata from the fGDB.
+    success = True
+    # For a given dataset, find out if it is published. If so, get the parsed metadata for the fGDB.
     if layer_name in layers:
+        if record is None:
+            record = find_record(get_gdb_metadata(gdb_path), layer)
+        if record is None:
+            LOGGER.warning('Layer not found in {}: {}'.format(gdb_path, layer))
+            return False
         # Metadata
-        metadata = get_metadata(gdb_path, layer)
-        if metadata:
+        if record['has_metadata']:
             # Get the layer's REST endpoint.
             layer_href = layers[layer_name]
-            # Update the published layer's metadata.
-            abstract = get_abstract(metadata)
+            # Update the published layer's metadata, where it differs from the current values.
+            attr = {}
+            abstract = record['abstract']
             if abstract:
-                try:
-                    update_resource(layer_href, {'abstract': abstract})
-                    LOGGER.info('Updated abstract: {}'.format(layer_name))
-                except:
-                    LOGGER.exception('Error during update of abstract for {}'.format(layer_name))
+                attr['abstract'] = abstract
             else:
                 LOGGER.warning('No abstract available for {}'.format(layer_name))
             # Update the layer title from metadata.
-            title = get_title(metadata)
+            title = record['title']
             if title:
-                try:
-                    update_resource(layer_href, {'title': title})
-                    LOGGER.info('Updated title: {}'.format(layer_name))
-                except:
-                    LOGGER.exception('Error during update of title for {}'.format(layer_name))
+                attr['title'] = title
             else:
                 LOGGER.warning('No title available for {}'.format(layer_name))
+            if attr:
+                try:
+                    changed = reconcile_resource(layer_href, attr)
+                    if changed:
+                        LOGGER.info('Updated {}: {}'.format(', '.join(sorted(changed)), layer_name))
+                    else:
+                        LOGGER.info('Metadata unchanged: {}'.format(layer_name))
+                except:
+                    LOGGER.exception('Error during update of metadata for {}'.format(layer_name))
+                    success = False
         else:
             LOGGER.warning('No metadata available for {}'.format(layer_name))
 
         # Styles
-        sld_string = convert_qml(gdb_path, layer_name, qml_path, LOGGER)
-        r = create_style(workspace, layer_name, sld_string)
-        if r.status_code == 200:
-            LOGGER.info('Style created: {}'.format(layer_name))
-        elif r.status_code == 201:
-            LOGGER.info('Style updated: {}'.format(layer_name))
+        if not qml_path:  # No QML file for this layer (metadata only).
+            return success
+        # SLDs are cached against a hash of the QML, layer schema and converter version, so
+        # that unchanged styles are neither converted nor uploaded again.
+        cache = sld_cache_connect()
+        key = style_key(qml_path, record['schema'], get_converter_version())
+        sld_string = get_sld(cache, key)
+        if not sld_string:
+            sld_string = build_sld(gdb_path, layer_name, qml_path)
+            if not sld_string:
+                cache.close()
+                return False
+            store_sld(cache, key, sld_string)
+        if is_uploaded(cache, workspace, layer_name, sld_string):
+            # Skip the upload, but still check that the layer's default style is set.
+            LOGGER.info('Style unchanged: {}'.format(layer_name))
         else:
-            LOGGER.warning('Style not changed: {}'.format(layer_name))
-        # Set the layer's default style.
-        if r.status_code in [200, 201]:
-            r = set_layer_style(workspace, layer_name)
+            r = create_style(workspace, layer_name, sld_string)
+            if r.status_code == 200:
+                LOGGER.info('Style created: {}'.format(layer_name))
+            elif r.status_code == 201:
+                LOGGER.info('Style updated: {}'.format(layer_name))
+            else:
+                LOGGER.warning('Style not changed: {}'.format(layer_name))
+                cache.close()
+                return False
+            record_upload(cache, workspace, layer_name, sld_string)
+        # Set the layer's default style (where not already set).
+        if set_layer_style(workspace, layer_name):
             LOGGER.info('Layer default style updated: {}'.format(layer_name))
+        cache.close()
+    return success
+
+
+def init_worker(layers, run_id=None):
+    """Pool initializer: store the dict of published layers once per worker process (rather
+    than pickling it into every task), and the checkpoint journal run ID (if any). If styles are
+    always converted by QGIS, initialise it here for reuse by all style conversions (otherwise
+    it is initialised on first use).
+    """
+    global LAYERS, RUN_ID
+    LAYERS = layers
+    RUN_ID = run_id
+    if get_qml_translator() == 'qgis':
+        init_qgis()
 
 
-def mp_handler(cddp_path=None):
+def dataset_fingerprint(gdb_fp, qml_path):
+    """Returns the checkpoint journal fingerprint for a dataset: its file GDB fingerprint, plus
+    the size and modification time of its QML file.
+    """
+    stat = os.stat(qml_path)
+    return '{}|{}|{}'.format(gdb_fp, stat.st_size, stat.st_mtime_ns)
+
+
+def update_gdb_metadata(gdb_path, datasets, layers=None):
+    """Update metadata & styles for a group of datasets that share a single file GDB, whose
+    metadata is extracted (opening the file GDB only once) or read from the metadata cache.
+    If layers is not passed in, the worker's LAYERS dict is used.
+    """
+    if layers is None:
+        layers = LAYERS
+    # Only read the file GDB if at least one of its layers is published.
+    if not any(layer.lower() in layers for _, layer, _ in datasets):
+        return
+    try:
+        gdb_fp = gdb_fingerprint(gdb_path)
+        records = get_gdb_metadata(gdb_path, fingerprint=gdb_fp)
+    except:
+        LOGGER.exception('Error reading metadata from {}'.format(gdb_path))
+        return
+    # An error updating one layer must not prevent updates to the file GDB's other layers.
+    for dataset in datasets:
+        error = None
+        try:
+            success = update_metadata(dataset, layers, find_record(records, dataset[1]))
+        except Exception as e:
+            LOGGER.exception('Error during update of metadata & style for {}'.format(dataset[1]))
+            success, error = False, str(e)
+        # Only completed datasets are skipped by a resumed run.
+        if RUN_ID and success:
+            record_done('metadata', RUN_ID, gdb_path, dataset[1], dataset_fingerprint(gdb_fp, dataset[2]))
+        elif RUN_ID:
+            record_failed('metadata', RUN_ID, gdb_path, dataset[1], error)
+
+
+def mp_handler(cddp_path=None, resume=False):
     """Multiprocessing handler to import metadata from file GDBs in the mounted CDDP volume.
+    Pass resume=True to continue an interrupted run, skipping datasets that it already completed
+    from an unchanged source.
     """
     if not cddp_path:
         # Assume that this path set via an environment variable if not explicitly passed in.
         cddp_path = os.getenv('CDDP_PATH')
 
+    check_qml_translator()
     datasets = parse_cddp_qmls(cddp_path, LOGGER)
+    # Each completed dataset is recorded in the checkpoint journal.
+    run_id, completed = start_run('metadata', resume)
+    if completed:
+        fingerprints = gdb_fingerprints(datasets)
+        remaining = [d for d in datasets if completed.get(d[:2]) != dataset_fingerprint(fingerprints[d[0]], d[2])]
+        LOGGER.info('Resuming interrupted run: {} datasets already completed'.format(len(datasets) - len(remaining)))
+        datasets = remaining
     workspace = os.getenv('GEOSERVER_WORKSPACE')
     layers = get_layers(workspace)
+    # Bulk-fetch (or read) the catalog snapshot of layer resources, for use by the workers.
+    get_catalog_snapshot(workspace, layers)
     LOGGER.info('{} datasets scheduled for metadata & style updates'.format(len(datasets)))
 
+    # Group datasets by file GDB, so that each GDB is opened once.
+    gdbs = {}
+    for dataset in datasets:
+        gdbs.setdefault(dataset[0], []).append(dataset)
+
     # Use a multiprocessing Pool to update layer metadata in parallel.
-    p = Pool(processes=4)
-    iterable = [(dataset, layers) for dataset in datasets]
-    p.starmap(update_metadata, iterable)
+    p = Pool(processes=4, initializer=init_worker, initargs=(layers, run_id))
+    p.starmap(update_gdb_metadata, gdbs.items(), chunksize=1)
+    # Close the pool (rather than terminating it), so that each worker exits QGIS cleanly.
+    p.close()
+    p.join()
+    finish_run('metadata', run_id)
 
 
 if __name__ == "__main__":
-    mp_handler()
+    parser = argparse.ArgumentParser(description='Update metadata & styles for published CDDP layers')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted run, skipping datasets it already completed')
+    args = parser.parse_args()
+    mp_handler(resume=args.resume)
@@ -0,0 +1,99 @@
+from datetime import datetime, timezone
+import json
+import os
+
+from gdb_utils import extract_gdb_metadata
+from manifest import gdb_fingerprint
+from utils import state_connect
+
+
+def metadata_cache_connect(cache_path=None):
+    """Open (and create, if required) the SQLite metadata cache. Returns a connection object.
+    """
+    return state_connect('metadata_cache.sqlite', [
+        # The fingerprint of each file GDB when its metadata was last extracted.
+        '''CREATE TABLE IF NOT EXISTS gdbs (
+            file_gdb TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            extracted_at TEXT NOT NULL
+        )''',
+        # Parsed metadata records (JSON) for each layer in each file GDB.
+        '''CREATE TABLE IF NOT EXISTS records (
+            file_gdb TEXT NOT NULL,
+            layer_name TEXT NOT NULL,
+            record TEXT NOT NULL,
+            PRIMARY KEY (file_gdb, layer_name)
+        )''',
+        # The file GDB fingerprint when each layer's metadata XML was last exported to a file
+        # (see qgis-tools/extract_metadata.py).
+        '''CREATE TABLE IF NOT EXISTS exports (
+            file_gdb TEXT NOT NULL,
+            layer_name TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            PRIMARY KEY (file_gdb, layer_name)
+        )''',
+    ], cache_path or os.getenv('METADATA_CACHE_PATH'))
+
+
+def get_cached_metadata(conn, file_gdb, fingerprint=None):
+    """Returns the cached dict of {layer_name: record} for a file GDB, or None if the file GDB
+    has not been extracted (or, if a fingerprint is passed in, it was extracted with a different
+    fingerprint). Passing no fingerprint reads the cache without touching the file GDB at all.
+    """
+    row = conn.execute('SELECT fingerprint FROM gdbs WHERE file_gdb = ?', (file_gdb,)).fetchone()
+    if row is None or (fingerprint is not None and row[0] != fingerprint):
+        return None
+    rows = conn.execute('SELECT layer_name, record FROM records WHERE file_gdb = ?', (file_gdb,))
+    return {layer_name: json.loads(record) for layer_name, record in rows}
+
+
+def store_metadata(conn, file_gdb, fingerprint, records):
+    """Replace the cached metadata records for a file GDB.
+    """
+    with conn:
+        conn.execute('DELETE FROM records WHERE file_gdb = ?', (file_gdb,))
+        conn.executemany(
+            'INSERT INTO records (file_gdb, layer_name, record) VALUES (?, ?, ?)',
+            [(file_gdb, layer_name, json.dumps(record)) for layer_name, record in records.items()],
+        )
+        conn.execute(
+            'INSERT OR REPLACE INTO gdbs (file_gdb, fingerprint, extracted_at) VALUES (?, ?, ?)',
+            (file_gdb, fingerprint, datetime.now(timezone.utc).isoformat()),
+        )
+
+
+def get_gdb_metadata(file_gdb, conn=None, fgdb=None, fingerprint=None):
+    """Returns a dict of {layer_name: record} of the parsed metadata for all layers in a file GDB
+    (see gdb_utils.extract_gdb_metadata). Records are read from the cache while the file GDB's
+    fingerprint (calculated here, unless passed in) is unchanged; otherwise the file GDB is
+    opened once (or an already-opened datasource reused) and all of its layers extracted and cached.
+    """
+    close = conn is None
+    if conn is None:
+        conn = metadata_cache_connect()
+    if fingerprint is None:
+        fingerprint = gdb_fingerprint(file_gdb)
+    records = get_cached_metadata(conn, file_gdb, fingerprint)
+    if records is None:
+        records = extract_gdb_metadata(file_gdb, fgdb)
+        store_metadata(conn, file_gdb, fingerprint, records)
+    if close:
+        conn.close()
+    return records
+
+
+def is_exported(conn, file_gdb, layer_name, fingerprint):
+    """Returns True if a layer's metadata was last exported with an identical file GDB fingerprint.
+    """
+    row = conn.execute(
+        'SELECT fingerprint FROM exports WHERE file_gdb = ? AND layer_name = ?', (file_gdb, layer_name)
+    ).fetchone()
+    return row is not None and row[0] == fingerprint
+
+
+def record_export(conn, file_gdb, layer_name, fingerprint):
+    conn.execute(
+        'INSERT OR REPLACE INTO exports (file_gdb, layer_name, fingerprint) VALUES (?, ?, ?)',
+        (file_gdb, layer_name, fingerprint),
+    )
+    conn.commit()
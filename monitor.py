@@ -1,39 +1,186 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from geoserver import get_client
+from latency import latency_connect, record_samples, detect_regressions
+import json
+import math
 import os
 import requests
+import threading
 import time
-from utils import logger_setup, get_layers, layer_getmap_extent
-import xml.etree.ElementTree as ET
+from report import write_atomic
+from utils import (
+    logger_setup, get_catalog_snapshot, get_layers, get_state_path, layer_getmap_request, get_wmts_layers, wmts_tile_params,
+)
 
 
 # Configure logging.
 LOGGER = logger_setup()
 
 
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter, allowing an average of `rate` acquisitions per
+    second with bursts of up to `burst`.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def percentile(values, p):
+    """Returns the pth percentile (nearest-rank) of a list of values, or None if it is empty.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def latency_summary(values):
+    return {
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+def new_result(layer_name, error=None):
+    """Returns a new (failed) probe result dict for a layer.
+    """
+    return {
+        'layer': layer_name, 'ok': False, 'status_code': None, 'content_type': None,
+        'bytes': 0, 'ttfb': None, 'total': None, 'error': error,
+    }
+
+
+def probe(layer_name, url, params, bucket, content_type='image/jpeg'):
+    """Request a single image (tile or map) for a layer once a rate limiter token is available,
+    measuring the time to first byte and the total time. Returns a result dict.
+    """
+    bucket.acquire()
+    result = new_result(layer_name)
+    start = time.perf_counter()
+    try:
+        r = get_client().get(url, params=params, authenticate=False, stream=True)
+        chunks = r.iter_content(chunk_size=64 * 1024)
+        first = next(chunks, b'')
+        result['ttfb'] = time.perf_counter() - start
+        result['bytes'] = len(first) + sum(len(chunk) for chunk in chunks)
+        result['total'] = time.perf_counter() - start
+        r.close()
+        result['status_code'] = r.status_code
+        result['content_type'] = r.headers.get('Content-Type')
+        result['ok'] = r.status_code == 200 and result['content_type'] == content_type
+    except requests.RequestException as e:
+        result['total'] = time.perf_counter() - start
+        result['error'] = str(e)
+    return result
+
+
+def probe_layers(probes, mode, workers=None, rate=None, failures=None):
+    """Concurrently probe a list of (layer_name, url, params) tuples, at a rate limited to
+    MONITOR_RATE requests per second. Logs per-layer latency, plus p50/p95/p99 summaries of the
+    time to first byte and total time. Latencies are compared against each layer's baseline for
+    the mode ('wmts' or 'wms') and then recorded, and a JSON report is written (including any
+    latency regressions). Layers that could not be probed at all may be passed in as a list of
+    failed result dicts (see new_result), to be reported with the others. Returns the result dicts.
+    """
+    workers = workers or int(os.getenv('MONITOR_WORKERS', 8))
+    rate = rate or float(os.getenv('MONITOR_RATE', 10))
+    bucket = TokenBucket(rate, burst=workers)
+    LOGGER.info('{} published layers queued to query ({} workers, {}/s)'.format(len(probes), workers, rate))
+    started = time.time()
+    results = list(failures or [])
+    for result in results:
+        LOGGER.warning('Failed to query {}: {}'.format(result['layer'], result['error']))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(probe, layer_name, url, params, bucket) for layer_name, url, params in probes]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result['ok']:
+                LOGGER.info('Queried {} (ttfb {:.3f}s, total {:.3f}s)'.format(result['layer'], result['ttfb'], result['total']))
+            else:
+                LOGGER.warning('Failed to query {}: {}'.format(
+                    result['layer'], result['error'] or '{} {}'.format(result['status_code'], result['content_type'])))
+    finished = time.time()
+
+    # Compare against the baseline latencies, before recording this run.
+    conn = latency_connect()
+    regressions = detect_regressions(conn, mode, results)
+    record_samples(conn, mode, results, datetime.fromtimestamp(started, timezone.utc).isoformat())
+    conn.close()
+
+    failures = sorted(r['layer'] for r in results if not r['ok'])
+    summary = {
+        'mode': mode,
+        'layers': len(results),
+        'succeeded': len(results) - len(failures),
+        'failed': len(failures),
+        'regressed': len(regressions),
+        'ttfb': latency_summary([r['ttfb'] for r in results if r['ok']]),
+        'total': latency_summary([r['total'] for r in results if r['ok']]),
+    }
+    LOGGER.info('{}/{} published layers successfully queried in {:.1f}s'.format(summary['succeeded'], len(results), finished - started))
+    if failures:
+        LOGGER.info('Failed layers: {}'.format(', '.join(failures)))
+    for key in ['ttfb', 'total']:
+        if summary[key]['p50'] is not None:
+            LOGGER.info('Latency ({}): p50 {p50:.3f}s, p95 {p95:.3f}s, p99 {p99:.3f}s, max {max:.3f}s'.format(key, **summary[key]))
+    for regression in regressions:
+        LOGGER.warning('Latency regression for {layer}: {total:.3f}s (baseline {baseline:.3f}s, {ratio:.1f}x)'.format(**regression))
+
+    report_path = os.getenv('MONITOR_REPORT_PATH', get_state_path('monitor_report.json'))
+    report = {
+        'started': datetime.fromtimestamp(started, timezone.utc).isoformat(),
+        'finished': datetime.fromtimestamp(finished, timezone.utc).isoformat(),
+        'duration': finished - started,
+        'summary': summary,
+        'regressions': regressions,
+        'layers': sorted(results, key=lambda r: r['layer']),
+    }
+    write_atomic(report_path, json.dumps(report, indent=2))
+    return results
+
+
 def monitor_layers_wms(workspace=None):
     """Utility script to download the largest extent for all published WMS layers.
     """
     if not workspace:
         workspace = os.getenv('GEOSERVER_WORKSPACE')
     LOGGER.info('Querying for published layers')
+    # Read each layer's extent from the catalog snapshot, then query each WMS extent.
     layers = get_layers(workspace)
-    success = 0
-    failures = []
-
-    # Query each WMS extent:
-    for layer in layers.keys():
-        r = layer_getmap_extent(workspace, layer)
-        if r.headers['Content-Type'] == 'image/jpeg':
-            LOGGER.info('Queried {}'.format(layer))
-            success += 1
-        else:
-            LOGGER.warning('Failed to query {}'.format(layer))
-            failures.append(layer)
-
-        time.sleep(2)  # Pause 2 seconds between requests.
-
-    LOGGER.info('{}/{} published layers successfully queried'.format(success, len(layers)))
-    if failures:
-        LOGGER.info('Failed layers: {}'.format(', '.join(failures)))
+    snapshot = get_catalog_snapshot(workspace, layers)
+    probes = []
+    for layer, (_, resource) in sorted(snapshot.items()):
+        url, params = layer_getmap_request(workspace, layer, resource)
+        probes.append((layer, url, params))
+    # Layers omitted from the snapshot (their resource could not be fetched) are failures.
+    failures = [new_result(layer, 'Layer resource could not be fetched') for layer in sorted(set(layers) - set(snapshot))]
+
+    return probe_layers(probes, 'wms', failures=failures)
 
 
 def monitor_layers(workspace=None):
@@ -41,7 +188,7 @@ def monitor_layers(workspace=None):
     single tile of the most zoomed-in extent, in order to test the published style for
     that layer. This is faster than querying the whole extent of the dataset.
 
-    XML tree to layer tile matrixes of the capability document:
+    XML tree to layer tile matrixes of the capability document (see utils.parse_wmts_layers):
     Contents
     - Layer (per published layer)
       - Title
@@ -55,42 +202,15 @@ def monitor_layers(workspace=None):
     """
     if not workspace:
         workspace = os.getenv('GEOSERVER_WORKSPACE')
-    success = 0
-    failures = []
     LOGGER.info('Querying WMTS GetCapabilities document')
     url = '{}/geoserver/gwc/service/wmts'.format(os.getenv('GEOSERVER_URL'))
-    r = requests.get(url, params={'request': 'getcapabilities'})
-    ns = {'wmts': 'http://www.opengis.net/wmts/1.0', 'ows': 'http://www.opengis.net/ows/1.1'}
-    root = ET.fromstring(r.content)
-    layers = root.findall('.//wmts:Layer', ns)
-    LOGGER.info('{} published layers queued to query'.format(len(layers)))
-    for layer in layers:
-        tmsl = layer.find('.//wmts:TileMatrixSetLink', ns)
-        tml = tmsl.findall('.//wmts:TileMatrixLimits', ns)[-1]  # The last TileMatrixLimit is the most zoomed-in.
-        params = {
-            'layer': layer.find('ows:Identifier', ns).text,
-            'style': '',
-            'tilematrixset': tmsl.find('.//wmts:TileMatrixSet', ns).text,
-            'Service': 'WMTS',
-            'Request': 'GetTile',
-            'Version': '1.0.0',
-            'Format': 'image/jpeg',
-            'TileMatrix': tml.find('.//wmts:TileMatrix', ns).text,
-            'TileRow': tml.find('.//wmts:MaxTileRow', ns).text,
-            'TileCol': tml.find('.//wmts:MaxTileCol', ns).text,
-        }
-        r = requests.get(url, params=params)
-        layer_name = layer.find('ows:Identifier', ns).text.split(':')[1]
-        if r.headers['Content-Type'] == 'image/jpeg':
-            LOGGER.info('Queried {}'.format(layer_name))
-            success += 1
-        else:
-            LOGGER.warning('Failed to query {}'.format(layer_name))
-            failures.append(layer_name)
-
-    LOGGER.info('{}/{} published layers successfully queried'.format(success, len(layers)))
-    if failures:
-        LOGGER.info('Failed layers: {}'.format(', '.join(failures)))
+    probes = []
+    for descriptor in get_wmts_layers(url):
+        layer_name = descriptor['layer'].split(':')[1]
+        probes.append((layer_name, url, wmts_tile_params(descriptor)))
+
+    return probe_layers(probes, 'wmts')
+
 
 if __name__ == "__main__":
     monitor_layers()
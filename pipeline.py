@@ -0,0 +1,255 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import Pool
+import os
+import threading
+import time
+
+from db import get_connection_pool, launder
+import gdal_ingest
+from ingester import get_ingest_backend, ingest_gdb, postload_enabled, postload_layer, publish_one
+from manifest import gdb_fingerprint
+import metadata
+from metadata_cache import get_gdb_metadata
+from report import summarise, write_json_report, write_prometheus_textfile
+from scheduler import get_source_bytes, get_worker_count
+from utils import logger_setup, get_layers, get_state_path, iter_cddp
+
+
+# Configure logging.
+LOGGER = logger_setup()
+
+
+def find_qml(file_gdb, layer_name):
+    """Returns the path of the QML style file for a file GDB layer, or None if there isn't one.
+    """
+    qml_path = os.path.join(os.path.split(file_gdb)[0], '{}.qml'.format(layer_name))
+    return qml_path if os.path.exists(qml_path) else None
+
+
+class Pipeline(object):
+    """Streaming pipeline to ingest, publish and update the metadata & style of file GDB layers.
+    Each file GDB is queued for ingest as soon as it has been discovered, and each layer moves on
+    to the next stage as soon as its previous stage finishes: ingest (a process pool of
+    INGEST_WORKERS), post-load optimisation (if enabled, POSTLOAD_WORKERS threads), publishing
+    of new layers (PUBLISH_WORKERS threads), then metadata & style (a process pool of
+    METADATA_WORKERS). Each file GDB is fingerprinted, and its metadata extracted (or read from
+    the metadata cache), once for all of its layers.
+    """
+
+    def __init__(self, full=False):
+        # Fail fast on a QML translator that the metadata workers could never initialise.
+        metadata.check_qml_translator()
+        self.full = full
+        self.workspace = os.getenv('GEOSERVER_WORKSPACE')
+        self.datastore = os.getenv('GEOSERVER_DATASTORE')
+        self.lock = threading.Lock()
+        self.records = []
+        # Dict of {file_gdb: metadata records} per discovered file GDB (None until extracted), and
+        # the records of layers waiting on their file GDB's metadata.
+        self.metadata_records = {}
+        self.metadata_waiting = {}
+        self.extractions = []
+        # Dict of published layers and their URLs, updated as new layers are published.
+        self.layers = get_layers(self.workspace)
+
+        # Create the process pools first, before this process starts any other threads.
+        self.metadata_pool = Pool(
+            processes=int(os.getenv('METADATA_WORKERS', 2)), initializer=metadata.init_worker, initargs=({},))
+        if get_ingest_backend() == 'gdal':
+            gdal_ingest.check_bindings()
+            # Each worker process holds open a single database connection for all of its layers.
+            self.ingest_pool = Pool(processes=get_worker_count(), initializer=gdal_ingest.init_worker)
+        else:
+            self.ingest_pool = Pool(processes=get_worker_count())
+        if postload_enabled():
+            postload_workers = int(os.getenv('POSTLOAD_WORKERS', 2))
+            self.db_pool = get_connection_pool(postload_workers)
+            self.postload = ThreadPoolExecutor(max_workers=postload_workers)
+        else:
+            self.postload = None
+        self.publish = ThreadPoolExecutor(max_workers=int(os.getenv('PUBLISH_WORKERS', 4)))
+
+    def run(self, cddp_path):
+        """Run the pipeline over the CDDP filepath, returning once every stage has finished for
+        every layer. Returns a list of the ingest result records (see ingester.ingest_gdb_layer),
+        with added 'published' and 'metadata' stage statuses.
+        """
+        # Discovery feeds the ingest pool as each file GDB is listed, with either a task per layer
+        # or (if INGEST_BATCH_BY_GDB is set) one per file GDB.
+        batch_by_gdb = os.getenv('INGEST_BATCH_BY_GDB', 'false').lower() == 'true'
+        for file_gdb, layer_names in iter_cddp(cddp_path, LOGGER):
+            source_bytes = get_source_bytes([(file_gdb, layer_name) for layer_name in layer_names])
+            try:
+                fingerprint = gdb_fingerprint(file_gdb)
+            except OSError:
+                LOGGER.exception('Failed to fingerprint {}'.format(file_gdb))
+                continue
+            # Extract the file GDB's metadata in the metadata pool while its layers are copied.
+            self.metadata_records[file_gdb] = None
+            self.extractions.append(self.metadata_pool.apply_async(
+                get_gdb_metadata, (file_gdb,), {'fingerprint': fingerprint},
+                callback=partial(self.metadata_extracted, file_gdb),
+                error_callback=partial(self.metadata_extraction_failed, file_gdb),
+            ))
+            batches = [layer_names] if batch_by_gdb else [[layer_name] for layer_name in layer_names]
+            for batch in batches:
+                self.ingest_pool.apply_async(
+                    ingest_gdb, ((file_gdb, batch, fingerprint), self.full),
+                    callback=partial(self.ingested, source_bytes),
+                    error_callback=partial(self.stage_error, 'ingest', file_gdb),
+                )
+        LOGGER.info('Discovery complete')
+
+        # Wait for each stage to drain in turn: each stage only feeds the stages after it.
+        self.ingest_pool.close()
+        self.ingest_pool.join()
+        if self.postload:
+            self.postload.shutdown(wait=True)
+            self.db_pool.closeall()
+        self.publish.shutdown(wait=True)
+        # Metadata extraction callbacks may still queue metadata updates.
+        for extraction in self.extractions:
+            extraction.wait()
+        self.metadata_pool.close()
+        self.metadata_pool.join()
+        return self.records
+
+    def stage_error(self, stage, name, e):
+        LOGGER.error('{} failed for {}: {}'.format(stage.capitalize(), name, e))
+
+    def ingested(self, source_bytes, results):
+        # Runs in the ingest pool's result handler thread; exceptions must not escape.
+        try:
+            for record in results:
+                record['source_bytes'] = source_bytes[(record['file_gdb'], record['layer'])]
+                record['published'] = None
+                record['metadata'] = None
+                with self.lock:
+                    self.records.append(record)
+                if record['status'] == 'failed':
+                    continue
+                if record['status'] == 'copied' and self.postload:
+                    # The post-load stage updates the record in-place.
+                    future = self.postload.submit(postload_layer, self.db_pool, record)
+                    future.add_done_callback(partial(self.postloaded, record))
+                else:
+                    self.submit_publish(record)
+        except Exception:
+            LOGGER.exception('Error queueing ingested layers')
+
+    def postloaded(self, record, future):
+        try:
+            self.submit_publish(record)
+        except Exception:
+            LOGGER.exception('Error queueing {} for publishing'.format(record['layer']))
+
+    def submit_publish(self, record):
+        """Publish the layer's table, if it has been copied and isn't already published. Otherwise,
+        move straight on to the metadata & style stage.
+        """
+        if record['status'] == 'copied' and record['table'] not in self.layers:
+            future = self.publish.submit(publish_one, self.workspace, self.datastore, record['table'])
+            future.add_done_callback(partial(self.published, record))
+        else:
+            self.submit_metadata(record)
+
+    def published(self, record, future):
+        try:
+            result = future.result()
+            record['published'] = result['status']
+            if result['status'] == 'published':
+                LOGGER.info('Published featuretype {} ({:.1f}s)'.format(record['table'], result['elapsed']))
+                self.layers[record['table']] = '{}/geoserver/rest/workspaces/{}/layers/{}.json'.format(
+                    os.getenv('GEOSERVER_URL'), self.workspace, record['table'])
+                self.submit_metadata(record)
+            else:
+                LOGGER.error('Failed to publish featuretype {}: {}'.format(record['table'], result['error']))
+        except Exception:
+            LOGGER.exception('Error publishing {}'.format(record['table']))
+
+    def submit_metadata(self, record):
+        """Update the metadata & style of a published layer (see metadata.update_metadata).
+        Unchanged (skipped) layers are updated too, as their style may have changed.
+        """
+        # Skipped layers have no table set; look them up by the table that ogr2ogr created.
+        layer_href = self.layers.get(record['table'] or launder(record['layer']))
+        if not layer_href:
+            return
+        record['layer_href'] = layer_href
+        with self.lock:
+            records = self.metadata_records[record['file_gdb']]
+            if records is None:  # Wait for the file GDB's metadata to be extracted.
+                self.metadata_waiting.setdefault(record['file_gdb'], []).append(record)
+                return
+        self.submit_metadata_update(record, records)
+
+    def submit_metadata_update(self, record, records):
+        layer_href = record.pop('layer_href')
+        metadata_record = metadata.find_record(records, record['layer'])
+        if metadata_record is None:
+            record['metadata'] = 'failed'
+            LOGGER.error('No metadata record extracted for {} in {}'.format(record['layer'], record['file_gdb']))
+            return
+        dataset = (record['file_gdb'], record['layer'], find_qml(record['file_gdb'], record['layer']))
+        self.metadata_pool.apply_async(
+            metadata.update_metadata, (dataset, {record['layer'].lower(): layer_href}, metadata_record),
+            callback=partial(self.metadata_updated, record),
+            error_callback=partial(self.metadata_failed, record),
+        )
+
+    def metadata_extracted(self, file_gdb, records):
+        # Runs in the metadata pool's result handler thread; exceptions must not escape.
+        try:
+            with self.lock:
+                self.metadata_records[file_gdb] = records
+                waiting = self.metadata_waiting.pop(file_gdb, [])
+            for record in waiting:
+                self.submit_metadata_update(record, records)
+        except Exception:
+            LOGGER.exception('Error queueing metadata updates for {}'.format(file_gdb))
+
+    def metadata_extraction_failed(self, file_gdb, e):
+        self.stage_error('metadata extraction', file_gdb, e)
+        # Layers of the file GDB fail their metadata stage (see submit_metadata_update).
+        self.metadata_extracted(file_gdb, {})
+
+    def metadata_updated(self, record, result):
+        record['metadata'] = 'updated' if result else 'failed'
+
+    def metadata_failed(self, record, e):
+        record['metadata'] = 'failed'
+        self.stage_error('metadata update', record['layer'], e)
+
+
+def run_pipeline(cddp_path=None, full=False):
+    """Run the streaming pipeline (see Pipeline) over the mounted CDDP volume, and write a run
+    report. Pass full=True to copy every layer, regardless of the change manifest.
+    """
+    if not cddp_path:
+        # Assume that this path set via an environment variable if not explicitly passed in.
+        cddp_path = os.getenv('CDDP_PATH')
+    start = time.time()
+    records = Pipeline(full).run(cddp_path)
+    finished = time.time()
+
+    summary = summarise(records)
+    LOGGER.info('{}/{} layers successfully copied'.format(summary['copied'], len(records)))
+    LOGGER.info('{} unchanged layers skipped, {} layers failed'.format(summary['skipped'], summary['failed']))
+    LOGGER.info('{} new featuretypes were published, {} layers had metadata & style updated'.format(
+        sum(1 for r in records if r['published'] == 'published'), sum(1 for r in records if r['metadata'] == 'updated')))
+    LOGGER.info('Pipeline completed in {:.0f}s'.format(finished - start))
+    report_path = os.getenv('REPORT_PATH', get_state_path('ingest_report.json'))
+    write_json_report(records, report_path, start, finished)
+    LOGGER.info('Run report written to {}'.format(report_path))
+    if os.getenv('PROMETHEUS_TEXTFILE_PATH'):
+        write_prometheus_textfile(records, os.getenv('PROMETHEUS_TEXTFILE_PATH'), start, finished)
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Ingest, publish and update metadata & styles for CDDP file GDB layers')
+    parser.add_argument('--full', action='store_true', help='Copy all layers, including those unchanged since the last run')
+    args = parser.parse_args()
+    run_pipeline(full=args.full)
@@ -0,0 +1,71 @@
+import json
+import os
+
+
+# Named load profiles, mapping to ogr2ogr/GDAL options for the PostgreSQL target:
+# - gt: transaction group size (-gt), as a number of features or 'unlimited'.
+# - config: GDAL configuration options (--config).
+# - lco: layer creation options (-lco).
+# - defer_index: create the spatial index after the data is loaded, rather than during.
+PROFILES = {
+    # Default ogr2ogr settings.
+    'safe': {'gt': None, 'config': {}, 'lco': {}, 'defer_index': False},
+    'fast': {
+        'gt': 65536,
+        'config': {'PG_USE_COPY': 'YES', 'GDAL_CACHEMAX': '512'},
+        'lco': {'SPATIAL_INDEX': 'GIST'},
+        'defer_index': False,
+    },
+    'bulk': {
+        'gt': 'unlimited',
+        'config': {'PG_USE_COPY': 'YES', 'GDAL_CACHEMAX': '1024'},
+        'lco': {'SPATIAL_INDEX': 'NONE'},
+        'defer_index': True,
+    },
+}
+
+
+def load_profile_config():
+    """Load the optional load profile config file (LOAD_PROFILES_PATH), in the format:
+    {"profile": "fast", "layers": {"LAYER_NAME": {"profile": "bulk", "lco": {"FID": "objectid"}}}}
+    """
+    config_path = os.getenv('LOAD_PROFILES_PATH')
+    if not config_path or not os.path.exists(config_path):
+        return {}
+    with open(config_path) as f:
+        return json.load(f)
+
+
+def get_load_options(layer_name, config=None):
+    """Returns a dict of load options for a layer: the named profile (set by LOAD_PROFILE, the
+    config file, or per-layer) with any per-layer overrides from the config file applied.
+    """
+    if config is None:
+        config = load_profile_config()
+    overrides = config.get('layers', {}).get(layer_name, {})
+    profile_name = overrides.get('profile') or os.getenv('LOAD_PROFILE') or config.get('profile', 'safe')
+    if profile_name not in PROFILES:
+        raise ValueError('Unknown load profile: {}'.format(profile_name))
+
+    profile = PROFILES[profile_name]
+    options = {
+        'profile': profile_name,
+        'gt': overrides.get('gt', profile['gt']),
+        'config': dict(profile['config'], **overrides.get('config', {})),
+        'lco': dict(profile['lco'], **overrides.get('lco', {})),
+        'defer_index': overrides.get('defer_index', profile['defer_index']),
+    }
+    return options
+
+
+def ogr2ogr_args(options):
+    """Returns the ogr2ogr command-line arguments (as a string) for a dict of load options.
+    """
+    args = []
+    if options['gt']:
+        args.append('-gt {}'.format(options['gt']))
+    for key, value in options['lco'].items():
+        args.append('-lco {}={}'.format(key, value))
+    for key, value in options['config'].items():
+        args.append('--config {} {}'.format(key, value))
+    return ' '.join(args)
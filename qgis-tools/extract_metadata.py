@@ -1,73 +1,77 @@
 from os import path
+import sys
 from sys import argv
-import xml.etree.ElementTree as ET
-from bs4 import BeautifulSoup
 
-from osgeo import ogr
-from qgis.core import QgsApplication, QgsVectorLayer
+# Use the metadata extractor & cache from the parent (cddp-ingester) directory.
+sys.path.insert(0, path.abspath(path.join(path.dirname(__file__), '..')))
+from gdb_utils import get_metadata, open_gdb  # noqa: E402
+from manifest import gdb_fingerprint  # noqa: E402
+from metadata_cache import metadata_cache_connect, get_gdb_metadata, is_exported, record_export  # noqa: E402
 
 
-def extract_metadata_for_fgdb_layer(fgdb, fgdb_path, layer_name):
+def get_metadata_path(fgdb_path, layer_name):
+    return path.join(path.abspath(path.join(fgdb_path, '..')), "{}.xml".format(layer_name))
+
+
+def extract_metadata_for_fgdb_layer(record, fgdb_path, layer_name, fgdb):
     parent_dir = path.abspath(path.join(fgdb_path, '..'))
 
-    metadata_layer = fgdb.ExecuteSQL("GetLayerMetadata {}".format(layer_name))
-    metadata_string = metadata_layer.GetFeature(0).GetFieldAsString(0)
-    if not metadata_string:
-        print("No metadata found for {} in {}".format(layer_name, fgdb_path))
-        return
+    # The metadata cache holds only the parsed fields, so read the XML document from the fgdb.
+    metadata_string = get_metadata(fgdb_path, layer_name, fgdb)
 
-    metadata_path = path.join(parent_dir, "{}.xml".format(layer_name))
+    metadata_path = get_metadata_path(fgdb_path, layer_name)
     with open(metadata_path, "w+") as metadata_file:
         metadata_file.write(metadata_string)
 
-    root = ET.fromstring(metadata_string)
-    abstract_element = root.find("./dataIdInfo/idAbs")
-
-    if abstract_element is None:
-        print("No abstact element for {} in {}".format(layer_name, fgdb_path))
-        return
-
-    abstract_html = abstract_element.text
-    abstract_text = BeautifulSoup(abstract_html, "lxml").text.strip()
-
+    abstract_text = record["abstract"]
     if not abstract_text:
         print("No abstact text for {} in {}".format(layer_name, fgdb_path))
         return
 
     abstract_path = path.join(parent_dir, "{}.abstract.txt".format(layer_name))
     with open(abstract_path, "w+") as abstract_file:
-        abstract_file.write(metadata_string)
+        abstract_file.write(abstract_text)
 
     print("Complete: {}".format(layer_name))
 
 
-def extract_metadata_for_fgdb_layers(fgdb_path):
+def extract_metadata_for_fgdb_layers(fgdb_path, conn):
     if not path.isdir(fgdb_path):
         print("Error: FGDB not found at {}".format(fgdb_path))
         return
 
-    driver = ogr.GetDriverByName("OpenFileGDB")
-    fgdb = driver.Open(fgdb_path, 0)
-    layer_names = [l.GetName() for l in fgdb]
-
-    for layer_name in layer_names:
-        extract_metadata_for_fgdb_layer(fgdb, fgdb_path, layer_name)
+    # Parsed metadata records are cached by file GDB fingerprint (see metadata_cache.py).
+    fingerprint = gdb_fingerprint(fgdb_path)
+    records = get_gdb_metadata(fgdb_path, conn, fingerprint=fingerprint)
+
+    # Layers already exported from an unchanged fgdb are skipped, and the fgdb is only opened if
+    # at least one layer's metadata needs exporting.
+    layers = []
+    for layer_name, record in records.items():
+        if not record["has_metadata"]:
+            print("No metadata found for {} in {}".format(layer_name, fgdb_path))
+        elif is_exported(conn, fgdb_path, layer_name, fingerprint) and path.exists(get_metadata_path(fgdb_path, layer_name)):
+            print("Unchanged: {}".format(layer_name))
+        else:
+            layers.append(layer_name)
+    if not layers:
+        return
+    fgdb = open_gdb(fgdb_path)
+    for layer_name in layers:
+        extract_metadata_for_fgdb_layer(records[layer_name], fgdb_path, layer_name, fgdb)
+        record_export(conn, fgdb_path, layer_name, fingerprint)
 
 
 def main():
-    QgsApplication.setPrefixPath("/usr", True)
-    qgis = QgsApplication([], False)
-    qgis.initQgis()
-
     params = argv[1:]
     if len(params) > 0:
+        conn = metadata_cache_connect()
         for param in params:
-            extract_metadata_for_fgdb_layers(param)
+            extract_metadata_for_fgdb_layers(param, conn)
+        conn.close()
     else:
         print("Usage: extract_metadata.py fgdb_path [fgdb_path2 ...]")
 
-    qgis.exitQgis()
-
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
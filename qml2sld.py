@@ -0,0 +1,363 @@
+import io
+import re
+import xml.etree.ElementTree as ET
+
+
+# Increment when the translation (translate_qml) changes, to invalidate cached SLDs.
+TRANSLATOR_VERSION = 2
+# Increment when the SLD clean-up (clean_sld) changes, to invalidate cached SLDs.
+SLD_CLEANUP_VERSION = 1
+
+# Define XML namespaces.
+NS = {
+    'sld': 'http://www.opengis.net/sld',
+    'se': 'http://www.opengis.net/se',
+    'ogc': 'http://www.opengis.net/ogc',
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+}
+SLD = '{http://www.opengis.net/sld}'
+SE = '{http://www.opengis.net/se}'
+OGC = '{http://www.opengis.net/ogc}'
+
+# Scale factors from QGIS size units to SLD pixels (0.28 mm per pixel, as for QGIS's SLD export).
+UNIT_SCALE = {'MM': 1 / 0.28, 'Point': 0.352778 / 0.28, 'Pixel': 1.0}
+# QGIS simple marker shapes, and the equivalent SLD well-known names.
+MARKER_NAMES = {
+    'circle': 'circle',
+    'square': 'square',
+    'triangle': 'triangle',
+    'star': 'star',
+    'cross': 'cross',
+    'cross2': 'x',
+    'x': 'x',
+}
+# QGIS pen styles as dash patterns, in multiples of the line width.
+DASH_PATTERNS = {
+    'dash': [4, 2],
+    'dot': [1, 2],
+    'dash dot': [4, 2, 1, 2],
+    'dash dot dot': [4, 2, 1, 2, 1, 2],
+}
+JOIN_STYLES = {'bevel': 'bevel', 'miter': 'mitre', 'round': 'round'}
+CAP_STYLES = {'square': 'square', 'flat': 'butt', 'round': 'round'}
+
+
+class UnsupportedQml(Exception):
+    """Raised when a QML style uses a construct that translate_qml does not support.
+    """
+    pass
+
+
+def clean_sld(sld, layer):
+    """Clean up an SLD document (bytes or string) for publishing against the database table
+    for a layer. Returns the XML string.
+    """
+    # Parse the SLD.
+    root = ET.fromstring(sld)
+    # Alter any Name elements where the element value == layer (uppercase).
+    for el in root.findall('.//se:Name', NS):
+        if el.text == layer:
+            el.text = el.text.lower()
+    # Alter any PropertyName element values to lowercase (these are db column names).
+    for el in root.findall('.//ogc:PropertyName', NS):
+        el.text = el.text.lower()
+    # TODO: additional SLD cleansing.
+
+    # Return the XML string.
+    ET.register_namespace('', 'http://www.opengis.net/sld')  # Register default namespace
+    for k, v in NS.items():  # Register remaining namespaces.
+        ET.register_namespace(k, v)
+    # Write a new XML tree to a file, then return the contents.
+    tree = ET.ElementTree(root)
+    f = io.StringIO()
+    tree.write(f, encoding='unicode')
+    f.seek(0)
+    return f.read()
+
+
+def get_props(element):
+    """Returns a dict of the properties of a QML symbol layer element, in either the
+    <prop k="" v=""/> format or the newer <Option type="Map"> format.
+    """
+    props = {prop.get('k'): prop.get('v') for prop in element.findall('prop')}
+    option_map = element.find('Option')
+    if option_map is not None:
+        for option in option_map.findall('Option'):
+            if option.get('name') is not None and option.get('value') is not None:
+                props[option.get('name')] = option.get('value')
+    return props
+
+
+def has_data_defined_properties(element):
+    """Returns True if an element has any active data-defined property overrides.
+    """
+    ddp = element.find('data_defined_properties')
+    if ddp is None:
+        return False
+    return any(o.get('name') == 'active' and o.get('value') == 'true' for o in ddp.iter('Option'))
+
+
+def parse_color(value, alpha=1.0):
+    """Parse a QGIS colour string ('r,g,b,a'), returning a tuple of (hex colour, opacity).
+    """
+    rgba = [int(i) for i in value.split(',')[:4]]
+    if len(rgba) == 3:
+        rgba.append(255)
+    return '#{:02x}{:02x}{:02x}'.format(*rgba[:3]), rgba[3] / 255 * alpha
+
+
+def to_pixels(value, unit):
+    if unit not in UNIT_SCALE:
+        raise UnsupportedQml('Unsupported size unit: {}'.format(unit))
+    return float(value) * UNIT_SCALE[unit]
+
+
+def number(value):
+    return '{:g}'.format(round(value, 2))
+
+
+def field_name(attr):
+    """Returns the field name for a renderer/label attribute, which may be a quoted field name.
+    Expressions are not supported.
+    """
+    attr = attr.strip()
+    if attr.startswith('"') and attr.endswith('"'):
+        attr = attr[1:-1]
+    if not re.match(r'^\w+$', attr):
+        raise UnsupportedQml('Unsupported expression: {}'.format(attr))
+    return attr
+
+
+def svg_parameter(parent, name, value):
+    el = ET.SubElement(parent, SE + 'SvgParameter', name=name)
+    el.text = value
+    return el
+
+
+def fill_element(parent, color, alpha):
+    hex_color, opacity = parse_color(color, alpha)
+    fill = ET.SubElement(parent, SE + 'Fill')
+    svg_parameter(fill, 'fill', hex_color)
+    if opacity < 1:
+        svg_parameter(fill, 'fill-opacity', number(opacity))
+    return fill
+
+
+def stroke_element(parent, color, alpha, width, unit, style, join=None, cap=None):
+    if style != 'solid' and style not in DASH_PATTERNS:
+        raise UnsupportedQml('Unsupported line style: {}'.format(style))
+    hex_color, opacity = parse_color(color, alpha)
+    width_px = to_pixels(width, unit)
+    stroke = ET.SubElement(parent, SE + 'Stroke')
+    svg_parameter(stroke, 'stroke', hex_color)
+    if opacity < 1:
+        svg_parameter(stroke, 'stroke-opacity', number(opacity))
+    if width_px > 0:  # A zero width is a QGIS 'hairline'; use the SLD default width.
+        svg_parameter(stroke, 'stroke-width', number(width_px))
+    if join in JOIN_STYLES:
+        svg_parameter(stroke, 'stroke-linejoin', JOIN_STYLES[join])
+    if cap in CAP_STYLES:
+        svg_parameter(stroke, 'stroke-linecap', CAP_STYLES[cap])
+    if style in DASH_PATTERNS:
+        dash_width = width_px or 1
+        svg_parameter(stroke, 'stroke-dasharray', ' '.join(number(i * dash_width) for i in DASH_PATTERNS[style]))
+    return stroke
+
+
+def check_offset(props, key='offset'):
+    if any(float(i) != 0 for i in props.get(key, '0,0').split(',')):
+        raise UnsupportedQml('Unsupported symbol offset')
+
+
+def add_symbolizers(rule, symbol, opacity=1.0):
+    """Append SLD symbolizers to a rule element for each enabled layer of a QML symbol.
+    """
+    if symbol.get('type') not in ('fill', 'line', 'marker'):
+        raise UnsupportedQml('Unsupported symbol type: {}'.format(symbol.get('type')))
+    if has_data_defined_properties(symbol):
+        raise UnsupportedQml('Unsupported data-defined symbol properties')
+    alpha = float(symbol.get('alpha', 1)) * opacity
+
+    for symbol_layer in symbol.findall('layer'):
+        if symbol_layer.get('enabled', '1') == '0':
+            continue
+        if has_data_defined_properties(symbol_layer):
+            raise UnsupportedQml('Unsupported data-defined symbol layer properties')
+        layer_class = symbol_layer.get('class')
+        props = get_props(symbol_layer)
+
+        if layer_class == 'SimpleFill':
+            check_offset(props)
+            symbolizer = ET.SubElement(rule, SE + 'PolygonSymbolizer')
+            if props.get('style', 'solid') == 'solid':
+                fill_element(symbolizer, props['color'], alpha)
+            elif props.get('style') != 'no':
+                raise UnsupportedQml('Unsupported fill style: {}'.format(props.get('style')))
+            if props.get('outline_style', 'solid') != 'no':
+                stroke_element(
+                    symbolizer, props['outline_color'], alpha, props.get('outline_width', 0),
+                    props.get('outline_width_unit', 'MM'), props.get('outline_style', 'solid'),
+                    props.get('joinstyle'))
+        elif layer_class == 'SimpleLine':
+            check_offset(props)
+            if props.get('use_custom_dash', '0') == '1':
+                raise UnsupportedQml('Unsupported custom dash pattern')
+            if props.get('line_style', 'solid') == 'no':
+                continue
+            symbolizer = ET.SubElement(rule, SE + 'LineSymbolizer')
+            stroke_element(
+                symbolizer, props['line_color'], alpha, props.get('line_width', 0),
+                props.get('line_width_unit', 'MM'), props.get('line_style', 'solid'),
+                props.get('joinstyle'), props.get('capstyle'))
+        elif layer_class == 'SimpleMarker':
+            check_offset(props)
+            if props.get('name', 'circle') not in MARKER_NAMES:
+                raise UnsupportedQml('Unsupported marker shape: {}'.format(props.get('name')))
+            symbolizer = ET.SubElement(rule, SE + 'PointSymbolizer')
+            graphic = ET.SubElement(symbolizer, SE + 'Graphic')
+            mark = ET.SubElement(graphic, SE + 'Mark')
+            ET.SubElement(mark, SE + 'WellKnownName').text = MARKER_NAMES[props.get('name', 'circle')]
+            fill_element(mark, props['color'], alpha)
+            if props.get('outline_style', 'solid') != 'no':
+                stroke_element(
+                    mark, props['outline_color'], alpha, props.get('outline_width', 0),
+                    props.get('outline_width_unit', 'MM'), props.get('outline_style', 'solid'))
+            ET.SubElement(graphic, SE + 'Size').text = number(to_pixels(props.get('size', 2), props.get('size_unit', 'MM')))
+            if float(props.get('angle', 0)) != 0:
+                ET.SubElement(graphic, SE + 'Rotation').text = number(float(props['angle']))
+        else:
+            raise UnsupportedQml('Unsupported symbol layer class: {}'.format(layer_class))
+
+
+def add_rule(feature_type_style, name, symbol, opacity, filter_element=None):
+    rule = ET.SubElement(feature_type_style, SE + 'Rule')
+    ET.SubElement(rule, SE + 'Name').text = name
+    description = ET.SubElement(rule, SE + 'Description')
+    ET.SubElement(description, SE + 'Title').text = name
+    if filter_element is not None:
+        rule.append(filter_element)
+    add_symbolizers(rule, symbol, opacity)
+    return rule
+
+
+def comparison(operator, field, value):
+    el = ET.Element(OGC + operator)
+    ET.SubElement(el, OGC + 'PropertyName').text = field
+    ET.SubElement(el, OGC + 'Literal').text = value
+    return el
+
+
+def add_label_rule(feature_type_style, labeling):
+    """Append a rule containing a TextSymbolizer for QGIS 'simple' labeling settings.
+    """
+    settings = labeling.find('settings')
+    text_style = settings.find('text-style') if settings is not None else None
+    if text_style is None:
+        raise UnsupportedQml('Missing label text style')
+    if text_style.get('isExpression', '0') == '1':
+        raise UnsupportedQml('Unsupported label expression')
+    rendering = settings.find('rendering')
+    if rendering is not None and rendering.get('scaleVisibility', '0') == '1':
+        raise UnsupportedQml('Unsupported scale-dependent labels')
+    if has_data_defined_properties(settings):
+        raise UnsupportedQml('Unsupported data-defined label properties')
+
+    rule = ET.SubElement(feature_type_style, SE + 'Rule')
+    symbolizer = ET.SubElement(rule, SE + 'TextSymbolizer')
+    label = ET.SubElement(symbolizer, SE + 'Label')
+    ET.SubElement(label, OGC + 'PropertyName').text = field_name(text_style.get('fieldName', ''))
+    font = ET.SubElement(symbolizer, SE + 'Font')
+    svg_parameter(font, 'font-family', text_style.get('fontFamily', 'Sans Serif'))
+    if text_style.get('fontItalic', '0') == '1':
+        svg_parameter(font, 'font-style', 'italic')
+    if int(text_style.get('fontWeight', 50)) >= 63:  # QFont weights: 50 is normal, 75 is bold.
+        svg_parameter(font, 'font-weight', 'bold')
+    font_size = to_pixels(text_style.get('fontSize', 10), text_style.get('fontSizeUnit', 'Point'))
+    svg_parameter(font, 'font-size', number(font_size))
+
+    text_buffer = text_style.find('text-buffer')
+    if text_buffer is not None and text_buffer.get('bufferDraw', '0') == '1':
+        halo = ET.SubElement(symbolizer, SE + 'Halo')
+        radius = to_pixels(text_buffer.get('bufferSize', 1), text_buffer.get('bufferSizeUnits', 'MM'))
+        ET.SubElement(halo, SE + 'Radius').text = number(radius)
+        fill_element(halo, text_buffer.get('bufferColor', '255,255,255,255'), float(text_buffer.get('bufferOpacity', 1)))
+    fill_element(symbolizer, text_style.get('textColor', '0,0,0,255'), float(text_style.get('textOpacity', 1)))
+
+
+def translate_qml(qml, layer):
+    """Translate a QML style definition (file path or XML string) into an SLD, without QGIS.
+    Supports single symbol, categorized and graduated renderers using simple fill, line and
+    marker symbol layers, plus simple labels. Raises UnsupportedQml for any other construct,
+    and for a style that could not be parsed (so that it may be converted by QGIS instead).
+    Returns the (cleaned) XML string.
+    """
+    try:
+        return qml_to_sld(qml, layer)
+    except (ET.ParseError, KeyError, ValueError, TypeError, AttributeError) as e:
+        raise UnsupportedQml('Unable to parse style ({}: {})'.format(type(e).__name__, e)) from e
+
+
+def qml_to_sld(qml, layer):
+    """Translate a QML style definition into an SLD (see translate_qml). Other exceptions are
+    raised for a style that could not be parsed (e.g. a missing symbol or property).
+    """
+    if qml.lstrip().startswith('<'):
+        root = ET.fromstring(qml)
+    else:
+        root = ET.parse(qml).getroot()
+    if root.get('hasScaleBasedVisibilityFlag', '0') == '1':
+        raise UnsupportedQml('Unsupported scale-based visibility')
+    renderer = root.find('renderer-v2')
+    if renderer is None:
+        raise UnsupportedQml('No renderer-v2 element')
+    opacity = float(root.findtext('layerOpacity', '1') or 1)
+    symbols = {s.get('name'): s for s in renderer.findall('symbols/symbol')}
+
+    sld = ET.Element(SLD + 'StyledLayerDescriptor', version='1.1.0')
+    named_layer = ET.SubElement(sld, SLD + 'NamedLayer')
+    ET.SubElement(named_layer, SE + 'Name').text = layer
+    user_style = ET.SubElement(named_layer, SLD + 'UserStyle')
+    ET.SubElement(user_style, SE + 'Name').text = layer
+    feature_type_style = ET.SubElement(user_style, SE + 'FeatureTypeStyle')
+
+    renderer_type = renderer.get('type')
+    if renderer_type == 'singleSymbol':
+        add_rule(feature_type_style, 'Single symbol', symbols['0'], opacity)
+    elif renderer_type == 'categorizedSymbol':
+        field = field_name(renderer.get('attr', ''))
+        for category in renderer.findall('categories/category'):
+            if category.get('render', 'true') != 'true':
+                continue
+            if category.find('val') is not None:
+                raise UnsupportedQml('Unsupported multiple-value category')
+            value = category.get('value', '')
+            if value:
+                filter_element = ET.Element(OGC + 'Filter')
+                filter_element.append(comparison('PropertyIsEqualTo', field, value))
+            else:  # The 'all other values' category.
+                filter_element = ET.Element(SE + 'ElseFilter')
+            add_rule(feature_type_style, category.get('label') or value, symbols[category.get('symbol')], opacity, filter_element)
+    elif renderer_type == 'graduatedSymbol':
+        field = field_name(renderer.get('attr', ''))
+        for i, range_element in enumerate(renderer.findall('ranges/range')):
+            if range_element.get('render', 'true') != 'true':
+                continue
+            filter_element = ET.Element(OGC + 'Filter')
+            both = ET.SubElement(filter_element, OGC + 'And')
+            # As for QGIS, the lower bound is inclusive for the first range only.
+            lower_operator = 'PropertyIsGreaterThanOrEqualTo' if i == 0 else 'PropertyIsGreaterThan'
+            both.append(comparison(lower_operator, field, range_element.get('lower')))
+            both.append(comparison('PropertyIsLessThanOrEqualTo', field, range_element.get('upper')))
+            add_rule(feature_type_style, range_element.get('label'), symbols[range_element.get('symbol')], opacity, filter_element)
+    else:
+        raise UnsupportedQml('Unsupported renderer: {}'.format(renderer_type))
+    if feature_type_style.find(SE + 'Rule') is None:
+        raise UnsupportedQml('No rendered categories or ranges')
+
+    labeling = root.find('labeling')
+    if labeling is not None and root.get('labelsEnabled', '1') == '1':
+        if labeling.get('type') != 'simple':
+            raise UnsupportedQml('Unsupported labeling: {}'.format(labeling.get('type')))
+        add_label_rule(feature_type_style, labeling)
+
+    return clean_sld(ET.tostring(sld, encoding='unicode'), layer)
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+from psycopg2 import sql
+
+from utils import logger_setup
+import work_queue
+from work_queue import (
+    LeaseHeartbeat, claim_task, complete_task, enqueue_tasks, extend_leases, get_results, queue_connect,
+    remaining_tasks,
+)
+
+
+# Configure logging.
+LOGGER = logger_setup()
+# Use a separate queue table, so that a real work queue is never touched.
+os.environ['INGEST_QUEUE_TABLE'] = 'cddp_ingest_queue_smoke_test'
+
+
+def get_task(conn, layer_name):
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('SELECT status, worker, attempts, copied_fingerprint FROM {} WHERE layer_name = %s').format(
+            work_queue.get_queue_table()), (layer_name,))
+        row = cur.fetchone()
+    conn.commit()
+    return row
+
+
+def smoke_test():
+    """Smoke test of the ingest work queue (see work_queue.py) against a throwaway PostgreSQL
+    database, set by the usual DATABASE_* environment variables: claims, heartbeats, lease
+    expiry & reclaiming, and the shared change manifest fingerprints.
+    """
+    conn = queue_connect()
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('TRUNCATE {}').format(work_queue.get_queue_table()))
+    conn.commit()
+
+    enqueue_tasks(conn, 'run1', [
+        ('/cddp/a.gdb', 'BIG', 'fp1', 100.0),
+        ('/cddp/a.gdb', 'SMALL', 'fp1', 1.0),
+        ('/cddp/b.gdb', 'MEDIUM', 'fp2', 10.0),
+    ])
+    assert remaining_tasks(conn) == 3
+
+    # Concurrent claims never return the same task.
+    claims = {}
+    barrier = threading.Barrier(3)
+
+    def claim(worker):
+        worker_conn = queue_connect()
+        barrier.wait()
+        claims[worker] = claim_task(worker_conn, worker, lease_seconds=2)
+        worker_conn.close()
+
+    threads = [threading.Thread(target=claim, args=('worker{}'.format(i),)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    claimed = sorted(task['layer_name'] for task in claims.values())
+    assert claimed == ['BIG', 'MEDIUM', 'SMALL'], claimed
+    assert claim_task(conn, 'worker3') is None
+    LOGGER.info('Concurrent claims OK: {}'.format(claimed))
+    owners = {task['layer_name']: worker for worker, task in claims.items()}
+
+    # A heartbeat keeps a worker's leases alive past their original expiry.
+    heartbeat = LeaseHeartbeat(owners['BIG'], LOGGER, lease_seconds=2)
+    heartbeat.start()
+    time.sleep(3)
+    assert extend_leases(conn, owners['MEDIUM'], lease_seconds=60) == 1
+    # SMALL's lease has expired, so it can be reclaimed by another worker; BIG's has not.
+    task = claim_task(conn, 'worker4', lease_seconds=60)
+    assert task['layer_name'] == 'SMALL', task
+    assert get_task(conn, 'SMALL')[2] == 2
+    assert claim_task(conn, 'worker4') is None
+    heartbeat.stop()
+    LOGGER.info('Heartbeat, lease expiry & reclaim OK')
+
+    # The original worker has lost its lease, so cannot complete the reclaimed task.
+    assert not complete_task(conn, owners['SMALL'], '/cddp/a.gdb', 'SMALL', 'done', {'layer': 'SMALL'}, True)
+    assert complete_task(conn, 'worker4', '/cddp/a.gdb', 'SMALL', 'done', {'layer': 'SMALL'}, True)
+    assert complete_task(conn, owners['MEDIUM'], '/cddp/b.gdb', 'MEDIUM', 'failed', {'layer': 'MEDIUM'})
+    assert complete_task(conn, owners['BIG'], '/cddp/a.gdb', 'BIG', 'done', {'layer': 'BIG'}, True)
+    assert remaining_tasks(conn) == 0
+    assert sorted(r['layer'] for r in get_results(conn, 'run1')) == ['BIG', 'MEDIUM', 'SMALL']
+    LOGGER.info('Completion OK')
+
+    # The fingerprints of copied layers are kept when re-queued; a failed layer has none.
+    enqueue_tasks(conn, 'run2', [
+        ('/cddp/a.gdb', 'BIG', 'fp1', 100.0),
+        ('/cddp/a.gdb', 'SMALL', 'fp1', 1.0),
+        ('/cddp/b.gdb', 'MEDIUM', 'fp2', 10.0),
+    ])
+    tasks = {}
+    for i in range(3):
+        task = claim_task(conn, 'worker5', lease_seconds=1)
+        tasks[task['layer_name']] = task
+    # Tasks are claimed most costly first.
+    assert list(tasks) == ['BIG', 'MEDIUM', 'SMALL'], list(tasks)
+    assert tasks['BIG']['fingerprint'] == tasks['BIG']['copied_fingerprint'] == 'fp1'
+    assert tasks['MEDIUM']['copied_fingerprint'] is None
+    LOGGER.info('Shared change manifest OK')
+
+    # Tasks whose lease expires after the maximum number of attempts are failed.
+    time.sleep(2)
+    for attempt in range(2):
+        while claim_task(conn, 'worker6', lease_seconds=1, max_attempts=3):
+            pass
+        time.sleep(2)
+    assert remaining_tasks(conn, max_attempts=3) == 0
+    assert get_task(conn, 'BIG')[0] == 'failed'
+    # Their failure is stored as the result, so the run report includes them.
+    results = {r['layer']: r for r in get_results(conn, 'run2')}
+    assert sorted(results) == ['BIG', 'MEDIUM', 'SMALL'], results
+    assert results['BIG']['status'] == 'failed' and 'Lease expired' in results['BIG']['error'], results['BIG']
+    LOGGER.info('Maximum attempts OK')
+
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('DROP TABLE {}').format(work_queue.get_queue_table()))
+    conn.commit()
+    conn.close()
+    LOGGER.info('Work queue smoke test passed')
+
+
+if __name__ == "__main__":
+    smoke_test()
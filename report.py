@@ -0,0 +1,99 @@
+from collections import Counter
+from datetime import datetime, timezone
+import json
+import os
+
+
+# Histogram bucket upper bounds, in seconds.
+DURATION_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600]
+# Per-layer duration fields of the result records, and the histogram metric name for each.
+DURATION_METRICS = [
+    ('wall_time', 'cddp_ingest_layer_duration_seconds', 'Total time taken to process a layer'),
+    ('copy_time', 'cddp_ingest_copy_duration_seconds', 'Time taken to copy a layer to the database'),
+    ('db_time', 'cddp_ingest_db_duration_seconds', 'Time taken by post-load database operations on a layer'),
+]
+
+
+def write_atomic(path, content):
+    # Write to a temporary file first, so that readers never see a partially-written file.
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def summarise(records):
+    """Returns a dict of run-level totals for a list of per-layer result records.
+    """
+    statuses = Counter(r['status'] for r in records)
+    return {
+        'layers': len(records),
+        'copied': statuses['copied'],
+        'skipped': statuses['skipped'],
+        'failed': statuses['failed'],
+        'retried': sum(1 for r in records if r['retry_reason']),
+        'features': sum(r['features'] or 0 for r in records),
+        'source_bytes': sum(r['source_bytes'] or 0 for r in records if r['status'] == 'copied'),
+    }
+
+
+def write_json_report(records, path, started, finished):
+    """Write a JSON run report containing run-level totals and every per-layer result record.
+    started and finished are Unix timestamps.
+    """
+    report = {
+        'started': datetime.fromtimestamp(started, timezone.utc).isoformat(),
+        'finished': datetime.fromtimestamp(finished, timezone.utc).isoformat(),
+        'duration': finished - started,
+        'summary': summarise(records),
+        'layers': records,
+    }
+    write_atomic(path, json.dumps(report, indent=2))
+
+
+def histogram_lines(name, values):
+    """Returns Prometheus exposition format lines for a histogram of the passed-in values.
+    """
+    lines = []
+    for bound in DURATION_BUCKETS:
+        lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, sum(1 for v in values if v <= bound)))
+    lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, len(values)))
+    lines.append('{}_sum {}'.format(name, sum(values)))
+    lines.append('{}_count {}'.format(name, len(values)))
+    return lines
+
+
+def write_prometheus_textfile(records, path, started, finished):
+    """Write run metrics in the Prometheus exposition format, for the node_exporter textfile collector.
+    Duration histograms only include layers that were copied.
+    """
+    summary = summarise(records)
+    lines = [
+        '# HELP cddp_ingest_layers Number of layers processed in the last run, by status.',
+        '# TYPE cddp_ingest_layers gauge',
+    ]
+    for status in ('copied', 'skipped', 'failed'):
+        lines.append('cddp_ingest_layers{{status="{}"}} {}'.format(status, summary[status]))
+    lines += [
+        '# HELP cddp_ingest_retried_layers Number of layers copied on a second attempt in the last run.',
+        '# TYPE cddp_ingest_retried_layers gauge',
+        'cddp_ingest_retried_layers {}'.format(summary['retried']),
+        '# HELP cddp_ingest_features Number of features copied in the last run.',
+        '# TYPE cddp_ingest_features gauge',
+        'cddp_ingest_features {}'.format(summary['features']),
+        '# HELP cddp_ingest_source_bytes Estimated source bytes copied in the last run.',
+        '# TYPE cddp_ingest_source_bytes gauge',
+        'cddp_ingest_source_bytes {}'.format(summary['source_bytes']),
+        '# HELP cddp_ingest_run_duration_seconds Duration of the last run.',
+        '# TYPE cddp_ingest_run_duration_seconds gauge',
+        'cddp_ingest_run_duration_seconds {}'.format(finished - started),
+        '# HELP cddp_ingest_last_run_timestamp_seconds Completion time of the last run.',
+        '# TYPE cddp_ingest_last_run_timestamp_seconds gauge',
+        'cddp_ingest_last_run_timestamp_seconds {}'.format(finished),
+    ]
+    copied = [r for r in records if r['status'] == 'copied']
+    for field, name, description in DURATION_METRICS:
+        lines.append('# HELP {} {}.'.format(name, description))
+        lines.append('# TYPE {} histogram'.format(name))
+        lines += histogram_lines(name, [r[field] for r in copied if r[field] is not None])
+    write_atomic(path, '\n'.join(lines) + '\n')
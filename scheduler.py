@@ -0,0 +1,146 @@
+from collections import Counter
+import hashlib
+import heapq
+import math
+import os
+
+from manifest import gdb_fingerprints, get_durations, layer_unchanged
+
+
+# Assumed copy throughput (source bytes per second), used until there is a history of copy durations.
+DEFAULT_THROUGHPUT = 5 * 1024 * 1024
+
+
+def get_worker_count():
+    """Returns the number of ingest worker processes: INGEST_WORKERS if set, otherwise the lesser
+    of the CPU count and the number of concurrent database connections allowed (DATABASE_MAX_CONNECTIONS).
+    """
+    if os.getenv('INGEST_WORKERS'):
+        return int(os.getenv('INGEST_WORKERS'))
+    return max(1, min(os.cpu_count() or 1, int(os.getenv('DATABASE_MAX_CONNECTIONS', 4))))
+
+
+def gdb_size(file_gdb):
+    """Returns the total on-disk size of a file GDB, in bytes.
+    """
+    return sum(i.stat().st_size for i in os.scandir(file_gdb) if i.is_file())
+
+
+def get_source_bytes(datasets):
+    """For a list of (file_gdb, layer_name) tuples, returns a dict of the estimated source size
+    (in bytes) of each layer: an even share of its file GDB's on-disk size.
+    """
+    layer_counts = Counter(file_gdb for file_gdb, layer_name in datasets)
+    sizes = {file_gdb: gdb_size(file_gdb) for file_gdb in layer_counts}
+    return {d: sizes[d[0]] / layer_counts[d[0]] for d in datasets}
+
+
+def estimate_costs(datasets, manifest, full=False, source_bytes=None, fingerprints=None):
+    """For a list of (file_gdb, layer_name) tuples, returns a dict of the estimated copy time
+    (in seconds) of each. Layers that will be skipped as unchanged cost nothing, layers with a
+    recorded duration reuse it, and other layers are estimated from their source size (see
+    get_source_bytes) at the throughput observed in previous runs.
+    The file GDB fingerprints may be passed in (otherwise, see gdb_fingerprints).
+    """
+    history = get_durations(manifest)
+    if source_bytes is None:
+        source_bytes = get_source_bytes(datasets)
+    if not full and fingerprints is None:
+        fingerprints = gdb_fingerprints(datasets)
+
+    # Derive throughput from layers having a recorded duration.
+    known = [d for d in datasets if d in history]
+    elapsed = sum(history[d] for d in known)
+    if known and elapsed > 0:
+        throughput = sum(source_bytes[d] for d in known) / elapsed or DEFAULT_THROUGHPUT
+    else:
+        throughput = DEFAULT_THROUGHPUT
+
+    costs = {}
+    for file_gdb, layer_name in datasets:
+        if not full and layer_unchanged(manifest, file_gdb, layer_name, fingerprints[file_gdb]):
+            costs[(file_gdb, layer_name)] = 0.0
+        elif (file_gdb, layer_name) in history:
+            costs[(file_gdb, layer_name)] = history[(file_gdb, layer_name)]
+        else:
+            costs[(file_gdb, layer_name)] = source_bytes[(file_gdb, layer_name)] / throughput
+    return costs
+
+
+def schedule(datasets, costs):
+    """Returns the list of datasets ordered for dispatch: most costly first.
+    """
+    return sorted(datasets, key=lambda d: costs[d], reverse=True)
+
+
+def batch_datasets(datasets, costs, workers):
+    """Group datasets into batches of (file_gdb, [layer_name, ...]) so that each file GDB is
+    opened once per worker. A file GDB whose total cost exceeds an even share of the work
+    across workers is split into several batches, to maintain balance.
+    Returns a tuple of ([batches], [batch costs]), ordered most costly first.
+    """
+    gdbs = {}
+    for file_gdb, layer_name in datasets:
+        gdbs.setdefault(file_gdb, []).append(layer_name)
+    target = sum(costs.values()) / workers
+
+    batches = []
+    for file_gdb, layer_names in gdbs.items():
+        layer_names = sorted(layer_names, key=lambda layer_name: costs[(file_gdb, layer_name)], reverse=True)
+        batch, batch_cost = [], 0.0
+        for layer_name in layer_names:
+            cost = costs[(file_gdb, layer_name)]
+            if batch and batch_cost + cost > target:
+                batches.append(((file_gdb, batch), batch_cost))
+                batch, batch_cost = [], 0.0
+            batch.append(layer_name)
+            batch_cost += cost
+        batches.append(((file_gdb, batch), batch_cost))
+
+    batches.sort(key=lambda b: b[1], reverse=True)
+    return [b[0] for b in batches], [b[1] for b in batches]
+
+
+def predict_makespan(task_costs, workers):
+    """Simulate dispatching tasks in the given order to whichever worker is free first.
+    Returns the predicted elapsed time (in seconds) until all tasks are complete.
+    """
+    finish_times = [0.0] * workers
+    for cost in task_costs:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + cost)
+    return max(finish_times)
+
+
+def predict_static_makespan(task_costs, workers):
+    """Predict the makespan of dispatching tasks in the given order using Pool.map's default
+    fixed-size chunks, for comparison with the cost-ordered schedule.
+    """
+    task_costs = list(task_costs)
+    chunksize = max(1, math.ceil(len(task_costs) / (workers * 4)))
+    chunks = [sum(task_costs[i:i + chunksize]) for i in range(0, len(task_costs), chunksize)]
+    return predict_makespan(chunks, workers)
+
+
+def parse_shard(value):
+    """Parse a shard specification of the form 'i/N' (e.g. '0/4' is the first of four shards).
+    Returns a tuple of (index, count).
+    """
+    try:
+        index, count = [int(i) for i in value.split('/')]
+    except ValueError:
+        raise ValueError('Invalid shard {}: expected i/N'.format(value))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('Invalid shard {}: index must be from 0 to N-1'.format(value))
+    return index, count
+
+
+def shard_datasets(datasets, index, count, by_gdb=False):
+    """Returns the subset of a list of (file_gdb, layer_name) tuples belonging to one of a
+    number of shards, partitioned by a stable hash of each dataset (or of its file GDB only, if
+    by_gdb is True). Every node must see the CDDP at the same path for shards to agree.
+    """
+    def shard(dataset):
+        key = dataset[0] if by_gdb else '{}|{}'.format(*dataset)
+        return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % count
+
+    return [d for d in datasets if shard(d) == index]
@@ -0,0 +1,68 @@
+import hashlib
+import os
+
+from utils import state_connect
+
+
+def sld_cache_connect(cache_path=None):
+    """Open (and create, if required) the SQLite SLD cache. Returns a connection object.
+    """
+    return state_connect('sld_cache.sqlite', [
+        # Generated SLDs, keyed by a hash of their inputs.
+        '''CREATE TABLE IF NOT EXISTS slds (
+            key TEXT PRIMARY KEY,
+            sld TEXT NOT NULL
+        )''',
+        # The hash of the SLD last uploaded to GeoServer for each layer.
+        '''CREATE TABLE IF NOT EXISTS uploads (
+            workspace TEXT NOT NULL,
+            layer_name TEXT NOT NULL,
+            sld_hash TEXT NOT NULL,
+            PRIMARY KEY (workspace, layer_name)
+        )''',
+    ], cache_path or os.getenv('SLD_CACHE_PATH'))
+
+
+def style_key(qml_path, schema, converter_version):
+    """Returns the cache key for a style: a hash of the QML contents, the layer schema and the
+    version of the QML to SLD converter.
+    """
+    h = hashlib.sha1()
+    with open(qml_path, 'rb') as f:
+        h.update(f.read())
+    h.update(schema.encode())
+    h.update(converter_version.encode())
+    return h.hexdigest()
+
+
+def sld_hash(sld_string):
+    return hashlib.sha1(sld_string.encode()).hexdigest()
+
+
+def get_sld(conn, key):
+    """Returns the cached SLD for a style key, or None.
+    """
+    row = conn.execute('SELECT sld FROM slds WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def store_sld(conn, key, sld_string):
+    conn.execute('INSERT OR REPLACE INTO slds (key, sld) VALUES (?, ?)', (key, sld_string))
+    conn.commit()
+
+
+def is_uploaded(conn, workspace, layer_name, sld_string):
+    """Returns True if the SLD is identical to the one last uploaded for the layer.
+    """
+    row = conn.execute(
+        'SELECT sld_hash FROM uploads WHERE workspace = ? AND layer_name = ?', (workspace, layer_name)
+    ).fetchone()
+    return row is not None and row[0] == sld_hash(sld_string)
+
+
+def record_upload(conn, workspace, layer_name, sld_string):
+    conn.execute(
+        'INSERT OR REPLACE INTO uploads (workspace, layer_name, sld_hash) VALUES (?, ?, ?)',
+        (workspace, layer_name, sld_hash(sld_string)),
+    )
+    conn.commit()
@@ -1,11 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from geoserver import get_client
+import hashlib
 import json
 import logging
 import os
+import re
 import requests
-import shutil
+import sqlite3
 import subprocess
 import sys
+import time
 import xml.etree.ElementTree as ET
 
 
@@ -19,6 +24,8 @@ def logger_setup():
     # Set up logging in a standardised way.
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
+    if logger.handlers:  # Already set up (e.g. by another imported module).
+        return logger
     handler = logging.StreamHandler(sys.stdout)
     handler.setLevel(logging.INFO)
     formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s')
@@ -27,35 +34,201 @@ def logger_setup():
     return logger
 
 
-def parse_cddp(cddp_path, logger=None):
-    '''This function expects the CDDP filepath to be passed in
-    (e.g. /mnt/GIS-CALM/GIS1-Corporate/Data/GDB), in order to walk the path and locate
-    file geodatabases for copying to the database.
-    Returns a list of tuples containing (path, layer_name) pairs.
-    '''
+def get_state_path(filename):
+    """Return the path to a persistent state file (manifests, caches, etc.), located in the
+    directory set by the STATE_DIR environment variable (defaults to the working directory).
+    """
+    state_dir = os.getenv('STATE_DIR', os.getcwd())
+    os.makedirs(state_dir, exist_ok=True)
+    return os.path.join(state_dir, filename)
+
+
+def state_connect(filename, schema, path=None):
+    """Open (and create, if required) a SQLite state store: the named file in the state
+    directory (see get_state_path), unless another path is passed in. The schema is a list of
+    CREATE ... IF NOT EXISTS statements, run on every connection. Returns a connection object.
+    """
+    # A store may be opened by several processes at once (pool workers, and the threads of the
+    # main process), so wait for another connection's write lock rather than failing.
+    conn = sqlite3.connect(path or get_state_path(filename), timeout=60)
+    for statement in schema:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+
+def get_pg_string():
+    """Returns a PostgreSQL connection string for the target database.
+    """
+    return 'host={} user={} password={} dbname={}'.format(
+        os.getenv('DATABASE_HOST'),
+        os.getenv('DATABASE_USERNAME'),
+        os.getenv('DATABASE_PASSWORD'),
+        os.getenv('DATABASE_NAME'),
+    )
+
+
+def find_gdbs(cddp_path):
+    """Walk the CDDP filepath and return a list of file GDB paths. The walk does not descend
+    into 'old' subdirectories, nor into the file GDB directories themselves.
+    """
+    if cddp_path.endswith('.gdb'):
+        return [cddp_path]
     gdb_paths = []
-    for i in os.walk(cddp_path):
-        if '/old/' in i[0]:  # Skip the 'old' subdirectories.
-            continue
-        if i[0].endswith('.gdb'):
-            gdb_paths.append(i[0])
+    for dirpath, dirnames, filenames in os.walk(cddp_path):
+        subdirs = []
+        for d in dirnames:
+            if d == 'old':  # Skip the 'old' subdirectories.
+                continue
+            if d.endswith('.gdb'):
+                gdb_paths.append(os.path.join(dirpath, d))
+                continue
+            subdirs.append(d)
+        dirnames[:] = subdirs  # Prune the walk in-place.
+    return gdb_paths
+
+
+def get_gdb_layers(file_gdb):
+    """Returns a list of layer names in a file GDB, as reported by ogrinfo.
+    """
+    gdb_layers = subprocess.check_output('ogrinfo -ro -so -q {}'.format(file_gdb), shell=True)
+    return [layer.split()[1].decode() for layer in gdb_layers.splitlines()]
+
+
+# Map declared (non-linear) file GDB geometry types to the linear type they should be loaded as.
+GEOMETRY_PROMOTIONS = {
+    'Multi Surface': 'MULTIPOLYGON',
+    'Curve Polygon': 'MULTIPOLYGON',
+    'Multi Curve': 'MULTILINESTRING',
+    'Compound Curve': 'MULTILINESTRING',
+    'Circular String': 'MULTILINESTRING',
+}
+
+
+def get_layer_geometry_type(file_gdb, layer_name, scan_features=False):
+    """Inspect a file GDB layer's geometry type prior to copying, and return the explicit
+    geometry type (ogr2ogr -nlt value) that it should be loaded as, or None if no
+    promotion/linearisation is required.
+    The declared layer type does not always reveal curved features (e.g. a Multi Polygon
+    layer containing Multi Surface features), so optionally also scan the layer's features.
+    """
+    summary = subprocess.check_output('ogrinfo -ro -so {} {}'.format(file_gdb, layer_name), shell=True)
+    match = re.search(r'^Geometry: (.+)$', summary.decode(), re.MULTILINE)
+    if not match:  # Non-spatial table.
+        return None
+    declared = match.group(1).strip()
+    if declared in GEOMETRY_PROMOTIONS:
+        return GEOMETRY_PROMOTIONS[declared]
+    if not scan_features:
+        return None
+
+    if 'Polygon' in declared:
+        curved, promotion = ('MULTISURFACE', 'CURVEPOLYGON'), 'MULTIPOLYGON'
+    elif 'Line' in declared:
+        curved, promotion = ('MULTICURVE', 'COMPOUNDCURVE', 'CIRCULARSTRING'), 'MULTILINESTRING'
+    else:
+        return None
+    where = 'OGR_GEOMETRY IN ({})'.format(', '.join("'{}'".format(i) for i in curved))
+    summary = subprocess.check_output('ogrinfo -ro -so -where "{}" {} {}'.format(where, file_gdb, layer_name), shell=True)
+    match = re.search(r'^Feature Count: (\d+)$', summary.decode(), re.MULTILINE)
+    if match and int(match.group(1)) > 0:
+        return promotion
+    return None
+
+
+def get_layer_feature_count(file_gdb, layer_name):
+    """Returns the feature count of a file GDB layer, as reported by ogrinfo (or None).
+    """
+    summary = subprocess.check_output('ogrinfo -ro -so {} {}'.format(file_gdb, layer_name), shell=True)
+    match = re.search(r'^Feature Count: (\d+)$', summary.decode(), re.MULTILINE)
+    return int(match.group(1)) if match else None
 
-    datasets = []
 
-    for file_gdb in gdb_paths:
+def discovery_cache_key(file_gdb):
+    """Returns the discovery cache key for a file GDB: the mtime of its directory, plus the mtime
+    and size of its system catalog table (a00000004.gdbtable), which is rewritten in place when
+    layers are added, removed or renamed without necessarily changing the directory mtime.
+    """
+    key = [os.stat(file_gdb).st_mtime_ns]
+    try:
+        stat = os.stat(os.path.join(file_gdb, 'a00000004.gdbtable'))
+        key += [stat.st_mtime_ns, stat.st_size]
+    except FileNotFoundError:
+        pass
+    return key
+
+
+def load_discovery_cache():
+    """Load the cache of file GDB layer lists, as a dict of {file_gdb: {'key': key, 'layers': [...]}}
+    (see discovery_cache_key).
+    """
+    cache_path = os.getenv('DISCOVERY_CACHE_PATH', get_state_path('discovery_cache.json'))
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except ValueError:  # Corrupt cache file; rebuild it.
+        return {}
+
+
+def save_discovery_cache(cache):
+    cache_path = os.getenv('DISCOVERY_CACHE_PATH', get_state_path('discovery_cache.json'))
+    # Write to a temporary file first, so that an interrupted write does not corrupt the cache.
+    tmp_path = '{}.tmp'.format(cache_path)
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+
+def iter_cddp(cddp_path, logger=None):
+    '''Generator version of parse_cddp: file GDBs are listed concurrently (DISCOVERY_WORKERS
+    threads), and a tuple of (path, [layer_name, ...]) is yielded for each file GDB (in walk
+    order) as soon as it has been listed. The discovery cache is saved once all file GDBs
+    have been listed.
+    '''
+    gdb_paths = find_gdbs(cddp_path)
+    cache = load_discovery_cache()
+
+    def list_layers(file_gdb):
+        key = discovery_cache_key(file_gdb)
+        cached = cache.get(file_gdb)
+        if cached and cached.get('key') == key:
+            return file_gdb, key, cached['layers']
         try:
-            gdb_layers = subprocess.check_output('ogrinfo -ro -so -q {}'.format(file_gdb), shell=True)
+            return file_gdb, key, get_gdb_layers(file_gdb)
         except subprocess.CalledProcessError:
             if logger:
                 logger.exception('ogrinfo step failed for {}'.format(file_gdb))
-            continue
+            return file_gdb, key, None
 
-        layers = gdb_layers.splitlines()
+    new_cache = {}
+    workers = int(os.getenv('DISCOVERY_WORKERS', 8))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Results are returned in walk order.
+        for file_gdb, key, layers in executor.map(list_layers, gdb_paths):
+            if layers is None:
+                continue
+            new_cache[file_gdb] = {'key': key, 'layers': layers}
+            yield (file_gdb, layers)
+
+    # Replacing (rather than updating) the cache drops entries for any GDBs that have been removed.
+    save_discovery_cache(new_cache)
 
-        for layer in layers:
-            layer_name = layer.split()[1].decode()
-            datasets.append((file_gdb, layer_name))
 
+def parse_cddp(cddp_path, logger=None):
+    '''This function expects the CDDP filepath to be passed in
+    (e.g. /mnt/GIS-CALM/GIS1-Corporate/Data/GDB), in order to walk the path and locate
+    file geodatabases for copying to the database.
+    File GDB layers are listed concurrently (DISCOVERY_WORKERS threads), and layer lists are
+    cached against each file GDB's directory and catalog table mtimes (see discovery_cache_key)
+    so that unchanged GDBs are not re-opened.
+    Returns a list of tuples containing (path, layer_name) pairs.
+    '''
+    datasets = []
+    for file_gdb, layers in iter_cddp(cddp_path, logger):
+        for layer_name in layers:
+            datasets.append((file_gdb, layer_name))
     return datasets
 
 
@@ -68,10 +241,14 @@ def parse_cddp_qmls(cddp_path, logger=None):
     # First, get fGDB layers.
     datasets = parse_cddp(cddp_path, logger)
     qml_paths = []
+    dir_listings = {}  # List each parent directory once, rather than checking for each QML file.
     for fgdb_path, layer in datasets:
-        qml_path = os.path.join(os.path.split(fgdb_path)[0], '{}.qml'.format(layer))
-        if os.path.exists(qml_path):
-            qml_paths.append((fgdb_path, layer, qml_path))
+        parent_dir = os.path.split(fgdb_path)[0]
+        if parent_dir not in dir_listings:
+            dir_listings[parent_dir] = set(os.listdir(parent_dir))
+        qml_file = '{}.qml'.format(layer)
+        if qml_file in dir_listings[parent_dir]:
+            qml_paths.append((fgdb_path, layer, os.path.join(parent_dir, qml_file)))
 
     return qml_paths
 
@@ -86,7 +263,7 @@ def get_available_featuretypes(workspace, datastore):
         os.getenv('GEOSERVER_URL'), workspace, datastore)
     headers = {'content-type': 'application/json', 'accept': 'application/json'}
     params = {'list': 'available'}
-    r = requests.get(url, auth=get_auth(), headers=headers, params=params)
+    r = get_client().get(url, headers=headers, params=params)
     if not r.status_code == 200:
         r.raise_for_status()
     return r.json()['list']['string']
@@ -98,7 +275,7 @@ def publish_featuretype(workspace, datastore, layer):
         os.getenv('GEOSERVER_URL'), workspace, datastore)
     headers = {'content-type': 'application/json', 'accept': 'application/json'}
     body = {'featureType': {'name': layer}}
-    r = requests.post(url, auth=get_auth(), headers=headers, data=json.dumps(body))
+    r = get_client().post(url, headers=headers, data=json.dumps(body))
     if not r.status_code == 201:
         r.raise_for_status()
     return r
@@ -110,7 +287,7 @@ def delete_featuretype(workspace, datastore, layer):
         os.getenv('GEOSERVER_URL'), workspace, datastore, layer)
     headers = {'content-type': 'application/json', 'accept': 'application/json'}
     params = {'recurse': 'true'}  # Also delete any layers associated with the featuretype.
-    r = requests.get(url, auth=get_auth(), headers=headers, params=params)
+    r = get_client().delete(url, headers=headers, params=params)
     if not r.status_code == 200:
         r.raise_for_status()
     return r
@@ -119,7 +296,7 @@ def delete_featuretype(workspace, datastore, layer):
 def get_layers(workspace):
     # Query a workspace endpoint, then return a dict of published layers and their URLs.
     url = '{}/geoserver/rest/workspaces/{}/layers'.format(os.getenv('GEOSERVER_URL'), workspace)
-    r = requests.get(url, auth=get_auth())
+    r = get_client().get(url)
     if not r.status_code == 200:
         r.raise_for_status()
     layers_list = r.json()['layers']['layer']
@@ -129,38 +306,180 @@ def get_layers(workspace):
 def get_layer(workspace, layer):
     # Query a published layer endpoint, then return details on that published layer as a dictionary.
     url = '{}/geoserver/rest/workspaces/{}/layers/{}'.format(os.getenv('GEOSERVER_URL'), workspace, layer)
-    r = requests.get(url, auth=get_auth())
+    r = get_client().get(url)
     if not r.status_code == 200:
         r.raise_for_status()
     return r.json()
 
 
+def catalog_connect(snapshot_path=None):
+    """Open (and create, if required) the SQLite catalog snapshot: the resource (featuretype)
+    details of each published layer. Returns a connection object.
+    """
+    return state_connect('catalog.sqlite', [
+        # The catalog revision of each workspace when it was last snapshotted.
+        '''CREATE TABLE IF NOT EXISTS snapshots (
+            workspace TEXT PRIMARY KEY,
+            revision TEXT NOT NULL,
+            fetched_at REAL NOT NULL
+        )''',
+        # The resource href and details (JSON) of each published layer.
+        '''CREATE TABLE IF NOT EXISTS resources (
+            workspace TEXT NOT NULL,
+            layer_name TEXT NOT NULL,
+            resource_href TEXT NOT NULL,
+            resource TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (workspace, layer_name)
+        )''',
+    ], snapshot_path or os.getenv('CATALOG_SNAPSHOT_PATH'))
+
+
+def catalog_revision(layers):
+    """Returns a revision string for a dict of published layers and their URLs (see get_layers).
+    """
+    h = hashlib.sha1()
+    for name, href in sorted(layers.items()):
+        h.update('{}|{}\n'.format(name, href).encode())
+    return h.hexdigest()
+
+
+def catalog_max_age():
+    # The maximum age (seconds) of snapshotted layer resources before they are fetched again.
+    return float(os.getenv('CATALOG_SNAPSHOT_MAX_AGE', 3600))
+
+
+def parse_layer_href(layer_href):
+    """Returns a tuple of (workspace, layer) from a layer REST endpoint URL.
+    """
+    m = re.search(r'/workspaces/([^/]+)/layers/([^/?]+?)(\.json)?(\?.*)?$', layer_href)
+    return (m.group(1), m.group(2))
+
+
+def fetch_layer_resource(layer_href, use_https=True):
+    """Get the resource object details for a layer from GeoServer. Returns a tuple of
+    (resource_href, dict).
+    """
+    # First, get the layer's existing details.
+    r = get_client().get(layer_href)
+    if not r.status_code == 200:
+        r.raise_for_status()
+    d = r.json()
+    # Next retrieve the layer's resource URL and get those details.
+    # We can infer this URL from the layer name, but let's be cautious.
+    resource_href = d['layer']['resource']['href']
+    if use_https and not resource_href.startswith('https'):
+        resource_href = resource_href.replace('http', 'https')
+    r = get_client().get(resource_href)
+    if not r.status_code == 200:
+        r.raise_for_status()
+    return (resource_href, r.json())
+
+
+def store_layer_resource(conn, workspace, layer, resource_href, resource, fetched_at=None):
+    conn.execute(
+        'INSERT OR REPLACE INTO resources (workspace, layer_name, resource_href, resource, fetched_at) VALUES (?, ?, ?, ?, ?)',
+        (workspace, layer, resource_href, json.dumps(resource), fetched_at or time.time()),
+    )
+    conn.commit()
+
+
+def get_catalog_snapshot(workspace, layers=None, conn=None):
+    """Returns a dict of {layer: (resource_href, resource dict)} for all published layers in a
+    workspace. The snapshot is read from the local cache while the workspace's catalog revision
+    (its list of published layers) is unchanged and the snapshot is less than
+    CATALOG_SNAPSHOT_MAX_AGE seconds old. Otherwise each layer's resource is fetched, using up
+    to CATALOG_WORKERS concurrent requests, and the snapshot replaced. Layers whose resource
+    could not be fetched are omitted.
+    """
+    close = conn is None
+    if conn is None:
+        conn = catalog_connect()
+    if layers is None:
+        layers = get_layers(workspace)
+    revision = catalog_revision(layers)
+    row = conn.execute('SELECT revision, fetched_at FROM snapshots WHERE workspace = ?', (workspace,)).fetchone()
+
+    if row and row[0] == revision and time.time() - row[1] < catalog_max_age():
+        rows = conn.execute('SELECT layer_name, resource_href, resource FROM resources WHERE workspace = ?', (workspace,))
+        snapshot = {layer: (resource_href, json.loads(resource)) for layer, resource_href, resource in rows}
+    else:
+        snapshot = {}
+        fetched_at = time.time()
+        with ThreadPoolExecutor(max_workers=int(os.getenv('CATALOG_WORKERS', 8))) as executor:
+            futures = {executor.submit(fetch_layer_resource, href): layer for layer, href in layers.items()}
+            for future, layer in futures.items():
+                try:
+                    snapshot[layer] = future.result()
+                except requests.RequestException:
+                    continue
+        with conn:
+            conn.execute('DELETE FROM resources WHERE workspace = ?', (workspace,))
+            conn.executemany(
+                'INSERT INTO resources (workspace, layer_name, resource_href, resource, fetched_at) VALUES (?, ?, ?, ?, ?)',
+                [(workspace, layer, href, json.dumps(resource), fetched_at) for layer, (href, resource) in snapshot.items()],
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO snapshots (workspace, revision, fetched_at) VALUES (?, ?, ?)',
+                (workspace, revision, fetched_at),
+            )
+    if close:
+        conn.close()
+    return snapshot
+
+
+def get_layer_resource(workspace, layer, layer_href=None, use_https=True, refresh=False):
+    """Returns a tuple of (resource_href, resource dict) for a published layer, from the catalog
+    snapshot where it is less than CATALOG_SNAPSHOT_MAX_AGE seconds old. Otherwise (or if
+    refresh is True, e.g. before the resource is written back) the resource is fetched from
+    GeoServer and stored in the snapshot.
+    """
+    conn = catalog_connect()
+    row = conn.execute(
+        'SELECT resource_href, resource, fetched_at FROM resources WHERE workspace = ? AND layer_name = ?',
+        (workspace, layer),
+    ).fetchone()
+    if row and not refresh and time.time() - row[2] < catalog_max_age():
+        conn.close()
+        return (row[0], json.loads(row[1]))
+    if not layer_href:
+        layer_href = '{}/geoserver/rest/workspaces/{}/layers/{}'.format(os.getenv('GEOSERVER_URL'), workspace, layer)
+    resource_href, resource = fetch_layer_resource(layer_href, use_https)
+    store_layer_resource(conn, workspace, layer, resource_href, resource)
+    conn.close()
+    return (resource_href, resource)
+
+
+def update_layer_resource(workspace, layer, resource_href, resource):
+    """Record a layer's updated resource details in the catalog snapshot (after a PUT).
+    """
+    conn = catalog_connect()
+    store_layer_resource(conn, workspace, layer, resource_href, resource)
+    conn.close()
+
+
 def update_layer(workspace, layer, title=None, abstract=None):
     # Update the title and/or abstract attributes for a published layer.
     # Returns the response object.
-    layer_dict = get_layer(workspace, layer)
-    # Get the layer resource URL.
-    resource_href = layer_dict['layer']['resource']['href'].replace('http', 'https')
-    r = requests.get(resource_href, auth=get_auth())
-    if not r.status_code == 200:
-        r.raise_for_status()
-    body = r.json()
+    # The whole resource is PUT back, so fetch it fresh rather than from the catalog snapshot.
+    resource_href, body = get_layer_resource(workspace, layer, refresh=True)
     # Update the title, then PUT to the layer resource URL.
     if title:
         body['featureType']['title'] = title
     if abstract:
         body['featureType']['abstract'] = abstract
     headers = {'content-type': 'application/json'}
-    r = requests.put(resource_href, auth=get_auth(), headers=headers, data=json.dumps(body))
+    r = get_client().put(resource_href, headers=headers, data=json.dumps(body))
     if not r.status_code == 200:
         r.raise_for_status()
+    update_layer_resource(workspace, layer, resource_href, body)
     return r
 
 
 def create_style(workspace, style, sld_string):
     # First, check if the style already exists.
     url = '{}/geoserver/rest/workspaces/{}/styles/{}.json'.format(os.getenv('GEOSERVER_URL'), workspace, style)
-    r = requests.get(url, auth=get_auth())
+    r = get_client().get(url)
     if r.status_code == 404:
         create = True
         # Create a new style in a workspace from an SLD XML string.
@@ -170,9 +489,9 @@ def create_style(workspace, style, sld_string):
         url = '{}/geoserver/rest/workspaces/{}/styles/{}'.format(os.getenv('GEOSERVER_URL'), workspace, style)
     headers = {'content-type': 'application/vnd.ogc.se+xml', 'accept': 'application/json'}
     if create:  # Create style.
-        r = requests.post(url, auth=get_auth(), headers=headers, data=sld_string)
+        r = get_client().post(url, headers=headers, data=sld_string)
     else:  # Update style.
-        r = requests.put(url, auth=get_auth(), headers=headers, data=sld_string)
+        r = get_client().put(url, headers=headers, data=sld_string)
     return r
 
 
@@ -180,31 +499,32 @@ def set_layer_style(workspace, layer):
     # Assumes that the layer and style have identical names.
     # First, get the layer details:
     url = '{}/geoserver/rest/workspaces/{}/layers/{}'.format(os.getenv('GEOSERVER_URL'), workspace, layer)
-    r = requests.get(url, auth=get_auth())
+    r = get_client().get(url)
     if not r.status_code == 200:
         r.raise_for_status()
     style_href = '{}/geoserver/rest/workspaces/{}/styles/{}.json'.format(os.getenv('GEOSERVER_URL'), workspace, layer)
     d = r.json()
+    # Returns None if the layer's default style is already set.
+    if (d['layer'].get('defaultStyle') or {}).get('name') in [layer, '{}:{}'.format(workspace, layer)]:
+        return None
     # Set the layer's default style.
     d['layer']['defaultStyle'] = {'name': layer, 'href': style_href}
     headers = {'content-type': 'application/json', 'accept': 'application/json'}
     # PUT to the layer URL.
-    r = requests.put(url, auth=get_auth(), headers=headers, data=json.dumps(d))
+    r = get_client().put(url, headers=headers, data=json.dumps(d))
     if not r.status_code == 200:
         r.raise_for_status()
     return r
 
 
-def layer_getmap_extent(workspace, layer):
-    """Utility function to download the layer full extent from the WMS endpoint, for monitoring purposes.
+def layer_getmap_request(workspace, layer, resource=None):
+    """Returns a tuple of (url, params) for a WMS GetMap request of the layer full extent.
+    The layer's resource details may be passed in (otherwise, see get_layer_resource).
     """
-    # First, obtain the bounding box from the layer resource URL.
-    layer_resp = get_layer(workspace, layer)
-    resource_href = layer_resp['layer']['resource']['href'].replace('http', 'https')
-    resource = requests.get(resource_href, auth=get_auth())
-    if not resource.status_code == 200:
-        resource.raise_for_status()
-    d = resource.json()
+    # First, obtain the bounding box from the layer resource.
+    if resource is None:
+        _, resource = get_layer_resource(workspace, layer)
+    d = resource
     bbox = d['featureType']['nativeBoundingBox']
     url = '{}/geoserver/{}/wms'.format(os.getenv('GEOSERVER_URL'), workspace)
     params = {
@@ -218,41 +538,124 @@ def layer_getmap_extent(workspace, layer):
         'height': 256,
         'srs': d['featureType']['srs'],
     }
-    r = requests.get(url, params=params)
-    if not resource.status_code == 200:
+    return (url, params)
+
+
+def layer_getmap_extent(workspace, layer):
+    """Utility function to download the layer full extent from the WMS endpoint, for monitoring purposes.
+    """
+    url, params = layer_getmap_request(workspace, layer)
+    r = get_client().get(url, params=params, authenticate=False)
+    if not r.status_code == 200:
         r.raise_for_status()
     return r
 
 
+def parse_wmts_layers(source):
+    """Incrementally parse a WMTS GetCapabilities document (a file-like object), yielding a
+    compact descriptor dict for each layer: its identifier, its first tile matrix set, and the
+    least and most zoomed-in tile matrix limits of that set. Parsed elements are cleared as we go.
+    """
+    ns = {'wmts': 'http://www.opengis.net/wmts/1.0', 'ows': 'http://www.opengis.net/ows/1.1'}
+    layer_tag = '{{{}}}Layer'.format(ns['wmts'])
+    for event, elem in ET.iterparse(source, events=('end',)):
+        if elem.tag != layer_tag:
+            continue
+        tmsl = elem.find('wmts:TileMatrixSetLink', ns)
+        limits = tmsl.findall('.//wmts:TileMatrixLimits', ns)
+        yield {
+            'layer': elem.find('ows:Identifier', ns).text,
+            'tilematrixset': tmsl.find('wmts:TileMatrixSet', ns).text,
+            'limits': [
+                {
+                    'matrix': tml.find('wmts:TileMatrix', ns).text,
+                    'row': tml.find('wmts:MaxTileRow', ns).text,
+                    'col': tml.find('wmts:MaxTileCol', ns).text,
+                }
+                for tml in (limits[0], limits[-1])  # The last TileMatrixLimit is the most zoomed-in.
+            ],
+        }
+        elem.clear()
+
+
+def get_wmts_layers(url=None, cache_path=None):
+    """Returns a list of WMTS layer descriptors (see parse_wmts_layers) for the GeoWebCache
+    GetCapabilities document. The descriptors are cached locally, and the document is only
+    downloaded again if GeoServer reports that it has changed (ETag / Last-Modified).
+    """
+    if not url:
+        url = '{}/geoserver/gwc/service/wmts'.format(os.getenv('GEOSERVER_URL'))
+    if not cache_path:
+        cache_path = os.getenv('WMTS_CAPABILITIES_CACHE_PATH', get_state_path('wmts_capabilities.json'))
+    cache = None
+    headers = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if cache.get('url') == url:
+            if cache.get('etag'):
+                headers['If-None-Match'] = cache['etag']
+            if cache.get('last_modified'):
+                headers['If-Modified-Since'] = cache['last_modified']
+        else:
+            cache = None
+
+    r = get_client().get(url, params={'request': 'getcapabilities'}, headers=headers, authenticate=False, stream=True)
+    if r.status_code == 304 and cache:
+        r.close()
+        return cache['layers']
+    if not r.status_code == 200:
+        r.raise_for_status()
+    r.raw.decode_content = True  # Decompress the streamed response, if required.
+    layers = list(parse_wmts_layers(r.raw))
+    r.close()
+
+    cache = {
+        'url': url,
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'layers': layers,
+    }
+    tmp_path = '{}.tmp'.format(cache_path)
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+    return layers
+
+
+def wmts_tile_params(descriptor, zoom=-1):
+    """Returns the GetTile request params for a WMTS layer descriptor, requesting the last tile
+    of the least zoomed-in (zoom=0) or the most zoomed-in (zoom=-1, default) tile matrix.
+    """
+    tml = descriptor['limits'][zoom]
+    return {
+        'layer': descriptor['layer'],
+        'style': '',
+        'tilematrixset': descriptor['tilematrixset'],
+        'Service': 'WMTS',
+        'Request': 'GetTile',
+        'Version': '1.0.0',
+        'Format': 'image/jpeg',
+        'TileMatrix': tml['matrix'],
+        'TileRow': tml['row'],
+        'TileCol': tml['col'],
+    }
+
+
 def query_wmts(save_tile=False):
     """Utility function to query WMTS layers and download tiles.
     """
     url = '{}/geoserver/gwc/service/wmts'.format(os.getenv('GEOSERVER_URL'))
-    r = requests.get(url, params={'request': 'getcapabilities'})
-    ns = {'wmts': 'http://www.opengis.net/wmts/1.0', 'ows': 'http://www.opengis.net/ows/1.1'}
-    root = ET.fromstring(r.content)
-    layers = root.findall('.//wmts:Layer', ns)
-    for layer in layers:
-        print(layer.find('ows:Identifier', ns).text.split(':')[1])
-        params = {
-            'layer': layer.find('ows:Identifier', ns).text,
-            'style': '',
-            'tilematrixset': layer.find('.//wmts:TileMatrixSet', ns).text,
-            'Service': 'WMTS',
-            'Request': 'GetTile',
-            'Version': '1.0.0',
-            'Format': 'image/jpeg',
-            'TileMatrix': layer.find('.//wmts:TileMatrix', ns).text,
-            'TileCol': layer.find('.//wmts:MaxTileCol', ns).text,
-            'TileRow': layer.find('.//wmts:MaxTileRow', ns).text,
-        }
-        r = requests.get(url, params=params)
+    for descriptor in get_wmts_layers(url):
+        layer_name = descriptor['layer'].split(':')[1]
+        print(layer_name)
+        params = wmts_tile_params(descriptor, zoom=0)
+        r = get_client().get(url, params=params, authenticate=False)
         if r.headers['Content-Type'] == 'image/jpeg':
             print('OK')
         else:
             print('ERROR')
         if save_tile:
-            filename = '{}.jpg'.format(layer.find('ows:Identifier', ns).text.split(':')[1])
+            filename = '{}.jpg'.format(layer_name)
             with open('tiles/{}'.format(filename), 'wb') as f:
-                r.raw.decode_content = True
-                shutil.copyfileobj(r.raw, f)
+                f.write(r.content)
@@ -0,0 +1,211 @@
+import os
+import socket
+import threading
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import Json
+
+from db import get_connection
+
+
+def get_queue_table():
+    return sql.Identifier(os.getenv('INGEST_QUEUE_SCHEMA', 'public'), os.getenv('INGEST_QUEUE_TABLE', 'cddp_ingest_queue'))
+
+
+def get_lease_seconds():
+    return int(os.getenv('INGEST_QUEUE_LEASE', 300))
+
+
+def get_max_attempts():
+    return int(os.getenv('INGEST_QUEUE_MAX_ATTEMPTS', 3))
+
+
+def get_worker_id():
+    """Returns an identifier for this worker process, unique across nodes.
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def queue_connect():
+    """Open a connection to the PostgreSQL database holding the ingest work queue, creating the
+    queue table if required. Returns a connection object.
+    """
+    conn = get_connection()
+    table = get_queue_table()
+    with conn.cursor() as cur:
+        # Serialise table creation between workers starting at the same time.
+        cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (table.strings[-1],))
+        # One row per layer. Status is pending, claimed (by a worker, until its lease expires),
+        # done or failed. The row is kept between runs, so that it also serves as the change
+        # manifest shared by all nodes: copied_fingerprint is the source file GDB fingerprint of
+        # the layer's last successful copy.
+        cur.execute(sql.SQL('''CREATE TABLE IF NOT EXISTS {} (
+            file_gdb TEXT NOT NULL,
+            layer_name TEXT NOT NULL,
+            run_id TEXT NOT NULL,
+            full_copy BOOLEAN NOT NULL DEFAULT FALSE,
+            priority DOUBLE PRECISION NOT NULL DEFAULT 0,
+            fingerprint TEXT,
+            copied_fingerprint TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_expires TIMESTAMPTZ,
+            result JSONB,
+            updated TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (file_gdb, layer_name)
+        )''').format(table))
+        cur.execute(sql.SQL('CREATE INDEX IF NOT EXISTS {} ON {} (status, priority DESC)').format(
+            sql.Identifier('{}_status_idx'.format(table.strings[-1])), table))
+    conn.commit()
+    return conn
+
+
+def enqueue_tasks(conn, run_id, tasks, full=False):
+    """Queue a list of (file_gdb, layer_name, fingerprint, priority) tuples for ingest by a run,
+    where fingerprint is that of the layer's file GDB when queued. Tasks are claimed highest
+    priority first. A layer already queued is reset to pending (keeping the fingerprint of its
+    last copy), unless it is currently claimed by a live worker.
+    """
+    query = sql.SQL('''INSERT INTO {} AS q (file_gdb, layer_name, run_id, full_copy, fingerprint, priority)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (file_gdb, layer_name) DO UPDATE SET
+            run_id = excluded.run_id, full_copy = excluded.full_copy, fingerprint = excluded.fingerprint,
+            priority = excluded.priority, status = 'pending', attempts = 0, worker = NULL, lease_expires = NULL,
+            result = NULL, updated = now()
+        WHERE q.status <> 'claimed' OR q.lease_expires < now()''').format(get_queue_table())
+    rows = [
+        (file_gdb, layer_name, run_id, full, fingerprint, priority)
+        for file_gdb, layer_name, fingerprint, priority in tasks
+    ]
+    with conn.cursor() as cur:
+        cur.executemany(query, rows)
+    conn.commit()
+
+
+def claim_task(conn, worker, lease_seconds=None, max_attempts=None):
+    """Claim the highest-priority available task: one that is pending, or whose previous
+    worker's lease has expired (up to INGEST_QUEUE_MAX_ATTEMPTS claims). Concurrent workers skip
+    rows locked by each other rather than waiting on them.
+    Returns a dict of the task's file_gdb, layer_name, full_copy, run_id, fingerprint and
+    copied_fingerprint, or None if no task is available.
+    """
+    lease_seconds = lease_seconds or get_lease_seconds()
+    max_attempts = max_attempts or get_max_attempts()
+    query = sql.SQL('''UPDATE {0} SET
+            status = 'claimed', worker = %s, attempts = attempts + 1,
+            lease_expires = now() + %s * interval '1 second', updated = now()
+        WHERE (file_gdb, layer_name) = (
+            SELECT file_gdb, layer_name FROM {0}
+            WHERE (status = 'pending' OR (status = 'claimed' AND lease_expires < now())) AND attempts < %s
+            ORDER BY priority DESC
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING file_gdb, layer_name, full_copy, run_id, fingerprint, copied_fingerprint''').format(get_queue_table())
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, (worker, lease_seconds, max_attempts))
+            row = cur.fetchone()
+            task = dict(zip([column.name for column in cur.description], row)) if row else None
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    return task
+
+
+def extend_leases(conn, worker, lease_seconds=None):
+    """Extend the lease on every task currently claimed by a worker. Returns the number of tasks.
+    """
+    lease_seconds = lease_seconds or get_lease_seconds()
+    query = sql.SQL("""UPDATE {} SET lease_expires = now() + %s * interval '1 second', updated = now()
+        WHERE worker = %s AND status = 'claimed'""").format(get_queue_table())
+    with conn.cursor() as cur:
+        cur.execute(query, (lease_seconds, worker))
+        count = cur.rowcount
+    conn.commit()
+    return count
+
+
+def complete_task(conn, worker, file_gdb, layer_name, status, result=None, copied=False):
+    """Mark a task claimed by a worker as done or failed, storing its result record (dict).
+    If the layer was copied, its queued fingerprint is recorded as that of its last copy.
+    Returns False if the worker no longer holds the task (its lease expired and the task was
+    claimed by another worker).
+    """
+    query = sql.SQL("""UPDATE {} SET
+            status = %s, result = %s, lease_expires = NULL, updated = now(),
+            copied_fingerprint = CASE WHEN %s THEN fingerprint ELSE copied_fingerprint END
+        WHERE file_gdb = %s AND layer_name = %s AND worker = %s AND status = 'claimed'""").format(get_queue_table())
+    with conn.cursor() as cur:
+        cur.execute(query, (status, Json(result) if result is not None else None, copied, file_gdb, layer_name, worker))
+        count = cur.rowcount
+    conn.commit()
+    return count == 1
+
+
+def remaining_tasks(conn, max_attempts=None):
+    """Returns the number of tasks not yet done or failed. Tasks whose lease has expired after
+    the maximum number of attempts are first marked as failed, with a result record of the
+    layer, its fingerprint and the error (to be completed by the reader, see get_results).
+    """
+    max_attempts = max_attempts or get_max_attempts()
+    table = get_queue_table()
+    query = sql.SQL('''UPDATE {} SET
+            status = 'failed', lease_expires = NULL, updated = now(),
+            result = jsonb_build_object(
+                'file_gdb', file_gdb, 'layer', layer_name, 'fingerprint', fingerprint, 'status', 'failed', 'worker', worker,
+                'error', format('Lease expired after %%s attempts (last claimed by %%s)', attempts, worker))
+        WHERE status = 'claimed' AND lease_expires < now() AND attempts >= %s''').format(table)
+    with conn.cursor() as cur:
+        cur.execute(query, (max_attempts,))
+        cur.execute(sql.SQL("SELECT count(*) FROM {} WHERE status IN ('pending', 'claimed')").format(table))
+        count = cur.fetchone()[0]
+    conn.commit()
+    return count
+
+
+def get_results(conn, run_id):
+    """Returns a list of the result records (dicts) stored by workers for the tasks of a run.
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL('SELECT result FROM {} WHERE run_id = %s AND result IS NOT NULL').format(
+            get_queue_table()), (run_id,))
+        return [row[0] for row in cur.fetchall()]
+
+
+class LeaseHeartbeat(threading.Thread):
+    """Background thread which periodically extends the leases of a worker's claimed tasks,
+    using its own database connection, until stopped. Leases are extended every third of
+    INGEST_QUEUE_LEASE, so a worker must miss several heartbeats before its tasks can be
+    claimed by another worker.
+    """
+
+    def __init__(self, worker, logger, lease_seconds=None):
+        super(LeaseHeartbeat, self).__init__(daemon=True)
+        self.worker = worker
+        self.logger = logger
+        self.lease_seconds = lease_seconds or get_lease_seconds()
+        self.stopped = threading.Event()
+
+    def run(self):
+        conn = None
+        while not self.stopped.wait(self.lease_seconds / 3.0):
+            try:
+                if conn is None:
+                    conn = get_connection()
+                extend_leases(conn, self.worker, self.lease_seconds)
+            except psycopg2.Error:
+                self.logger.exception('Failed to extend task leases for {}'.format(self.worker))
+                # Reconnect at the next heartbeat.
+                if conn is not None:
+                    conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()